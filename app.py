@@ -1,25 +1,30 @@
 import json
 import os
-import shutil
-import tempfile
+import threading
 import time
 import uuid
-from io import BytesIO
-from threading import Timer
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
 
 import gradio as gr
 from dotenv import load_dotenv
-from e2b_desktop import Sandbox
+from fastapi.responses import PlainTextResponse
 from gradio_modal import Modal
 from local_desktop import LocalDesktop
-from huggingface_hub import login, upload_folder
-from PIL import Image
+from log_uploader import LogUploader
+from metrics import Collector, render_metrics
+from huggingface_hub import login
 from smolagents import CodeAgent, InferenceClientModel
 from smolagents.gradio_ui import GradioUI
 
-from e2bqwen import E2BVisionAgent, OpenRouterModel, get_agent_summary_erase_images
+from e2bqwen import (
+    E2BVisionAgent,
+    ImageEncodingPolicy,
+    OpenRouterModel,
+    ResponseCache,
+)
 from gradio_script import stream_to_gradio
+from sandbox_pool import SandboxPool, create_e2b_sandbox
 from scripts_and_styling import (
     CUSTOM_JS,
     FOOTER_HTML,
@@ -27,6 +32,7 @@ from scripts_and_styling import (
     SANDBOX_HTML_TEMPLATE,
     apply_theme,
 )
+from trace_writer import StepTraceWriter
 
 load_dotenv(override=True)
 
@@ -42,12 +48,41 @@ E2B_API_KEY = os.getenv("E2B_API_KEY")
 USE_LOCAL_DESKTOP = os.getenv("USE_LOCAL_DESKTOP", "").lower() in ["true", "1"]
 SANDBOXES: dict[str, Any] = {}
 SANDBOX_METADATA: dict[str, dict[str, Any]] = {}
+# Number of agent runs in progress per session, whose sandbox and logs the reaper leaves alone
+ACTIVE_RUNS: dict[str, int] = {}
+# Guards SANDBOXES, SANDBOX_METADATA and ACTIVE_RUNS, which the reaper thread also reads or modifies
+SANDBOX_LOCK = threading.Lock()
 SANDBOX_TIMEOUT = int(os.getenv("SANDBOX_TIMEOUT", 300))
+REAPER_INTERVAL = int(os.getenv("REAPER_INTERVAL", 60))
+REAPER_STATS = {"runs": 0, "reaped": 0, "failed": 0}
 WIDTH = int(os.getenv("WIDTH", 1024))
 HEIGHT = int(os.getenv("HEIGHT", 768))
 TMP_DIR = "./tmp/"
+# Pre-booted E2B sandboxes, so that new sessions don't wait for a cold boot
+SANDBOX_POOL = SandboxPool(
+    create_sandbox=lambda: create_e2b_sandbox(
+        api_key=E2B_API_KEY, resolution=(WIDTH, HEIGHT), timeout=SANDBOX_TIMEOUT
+    ),
+    target_size=int(os.getenv("SANDBOX_POOL_SIZE", 1)),
+    max_size=int(os.getenv("SANDBOX_POOL_MAX_SIZE", 4)),
+    ttl=int(os.getenv("SANDBOX_POOL_TTL", SANDBOX_TIMEOUT - 60)),
+    session_timeout=SANDBOX_TIMEOUT,
+)
 if not os.path.exists(TMP_DIR):
     os.makedirs(TMP_DIR)
+# Interaction logs are staged on disk, then uploaded in batches by a background worker
+LOG_UPLOADER = LogUploader(
+    repo_id="smolagents/computer-agent-logs-2",
+    staging_dir=os.path.join(TMP_DIR, "upload_staging"),
+    skip_tasks=TASK_EXAMPLES,
+)
+
+# Opt-in cache of model responses, shared by all agents, for tasks that are run again and again
+RESPONSE_CACHE = (
+    ResponseCache(os.getenv("RESPONSE_CACHE_PATH"))
+    if os.getenv("RESPONSE_CACHE_PATH")
+    else None
+)
 
 hf_token = os.getenv("HF_TOKEN") or os.getenv("HUGGINGFACE_API_KEY")
 login(token=hf_token)
@@ -56,98 +91,172 @@ custom_css = SANDBOX_CSS_TEMPLATE.replace("<<WIDTH>>", str(WIDTH + 15)).replace(
     "<<HEIGHT>>", str(HEIGHT + 10)
 )
 
+# Read from the app's state when /metrics is scraped
+Collector(
+    "app_active_sandboxes",
+    "Sandboxes assigned to a session",
+    "gauge",
+    lambda: len(SANDBOXES),
+)
+Collector(
+    "sandbox_pool_sandboxes",
+    "Sandboxes in the pool, by state",
+    "gauge",
+    lambda: {
+        (state,): SANDBOX_POOL.get_metrics()[state] for state in ("idle", "booting")
+    },
+    labelnames=("state",),
+)
+Collector(
+    "sandbox_pool_events_total",
+    "Sandbox pool events",
+    "counter",
+    lambda: {
+        (event,): SANDBOX_POOL.get_metrics()[event]
+        for event in ("hits", "misses", "created", "create_failures", "expired")
+    },
+    labelnames=("event",),
+)
+Collector(
+    "log_upload_queue_size",
+    "Interaction log folders waiting for upload",
+    "gauge",
+    lambda: LOG_UPLOADER.queue_size(),
+)
+Collector(
+    "log_upload_events_total",
+    "Interaction log uploader events",
+    "counter",
+    lambda: {(event,): count for event, count in LOG_UPLOADER.stats.items()},
+    labelnames=("event",),
+)
+Collector(
+    "sandbox_reaper_events_total",
+    "Sandbox reaper runs, and sandboxes it reaped or failed to kill",
+    "counter",
+    lambda: {(event,): count for event, count in REAPER_STATS.items()},
+    labelnames=("event",),
+)
+Collector(
+    "model_response_cache_events_total",
+    "Model response cache lookups and updates",
+    "counter",
+    lambda: (
+        {(event,): count for event, count in RESPONSE_CACHE.stats.items()}
+        if RESPONSE_CACHE
+        else {}
+    ),
+    labelnames=("event",),
+)
+
 sandbox_html_template = SANDBOX_HTML_TEMPLATE.replace(
     "<<WIDTH>>", str(WIDTH + 15)
 ).replace("<<HEIGHT>>", str(HEIGHT + 10))
 
 
-def upload_to_hf_and_remove(folder_paths: list[str]):
-    repo_id = "smolagents/computer-agent-logs-2"
-
-    with tempfile.TemporaryDirectory(dir=TMP_DIR) as temp_dir:
-        print(
-            f"Uploading {len(folder_paths)} folders to {repo_id} (might end up with 0 folders uploaded if tasks are all examples)..."
-        )
-
-        # Copy all folders into the temporary directory
-        for folder_path in folder_paths:
-            folder_name = os.path.basename(os.path.normpath(folder_path))
-            target_path = os.path.join(temp_dir, folder_name)
-            print("Scanning folder", os.path.join(folder_path, "metadata.jsonl"))
-            if os.path.exists(os.path.join(folder_path, "metadata.jsonl")):
-                with open(os.path.join(folder_path, "metadata.jsonl"), "r") as f:
-                    json_content = [json.loads(line) for line in f]
-                # Skip upload if the task is in the examples
-                if json_content[0]["task"] not in TASK_EXAMPLES:
-                    print(f"Copying {folder_path} to temporary directory...")
-                    shutil.copytree(folder_path, target_path)
-            # Remove the original folder after copying
-            shutil.rmtree(folder_path)
-            print(f"Original folder {folder_path} removed.")
-
-        # Upload the entire temporary directory
-        print(f"Uploading all folders to {repo_id}...")
-        upload_folder(
-            folder_path=temp_dir,
-            repo_id=repo_id,
-            repo_type="dataset",
-            ignore_patterns=[".git/*", ".gitignore"],
-        )
-        print("Upload complete.")
-
-        return f"Successfully uploaded {len(folder_paths)} folders to {repo_id}"
+def kill_sandbox(session_id: str, desktop) -> bool:
+    try:
+        desktop.kill()
+        print(f"Cleaned up sandbox for session {session_id}")
+        return True
+    except Exception as e:
+        print(f"Error cleaning up sandbox {session_id}: {str(e)}")
+        return False
 
 
 def cleanup_sandboxes():
     """Remove sandboxes that haven't been accessed for longer than SANDBOX_TIMEOUT"""
     current_time = time.time()
-    sandboxes_to_remove = []
 
-    for session_id, metadata in SANDBOX_METADATA.items():
-        if current_time - metadata["last_accessed"] > SANDBOX_TIMEOUT:
-            sandboxes_to_remove.append(session_id)
+    with SANDBOX_LOCK:
+        expired_sessions = [
+            session_id
+            for session_id, metadata in SANDBOX_METADATA.items()
+            if current_time - metadata["last_accessed"] > SANDBOX_TIMEOUT
+            and not ACTIVE_RUNS.get(session_id)
+        ]
+        sandboxes_to_kill = {}
+        for session_id in expired_sessions:
+            del SANDBOX_METADATA[session_id]
+            if session_id in SANDBOXES:
+                sandboxes_to_kill[session_id] = SANDBOXES.pop(session_id)
+
+    # Hand the interaction logs of expired sessions to the uploader
+    for session_id in expired_sessions:
+        interaction_ids = INTERACTION_IDS_PER_SESSION_HASH.pop(session_id, {})
+        data_dirs = [
+            os.path.join(TMP_DIR, interaction_id)
+            for interaction_id in interaction_ids
+            if os.path.exists(os.path.join(TMP_DIR, interaction_id))
+        ]
+        LOG_UPLOADER.enqueue(data_dirs)
+
+    if sandboxes_to_kill:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(
+                executor.map(
+                    kill_sandbox, sandboxes_to_kill.keys(), sandboxes_to_kill.values()
+                )
+            )
+        REAPER_STATS["reaped"] += sum(results)
+        REAPER_STATS["failed"] += len(results) - sum(results)
+    REAPER_STATS["runs"] += 1
 
-    for session_id in sandboxes_to_remove:
-        if session_id in SANDBOXES:
-            try:
-                # Upload data before removing if needed
-                data_dir = os.path.join(TMP_DIR, session_id)
-                if os.path.exists(data_dir):
-                    upload_to_hf_and_remove(data_dir)
 
-                # Close the sandbox
-                SANDBOXES[session_id].kill()
-                del SANDBOXES[session_id]
-                del SANDBOX_METADATA[session_id]
-                print(f"Cleaned up sandbox for session {session_id}")
-            except Exception as e:
-                print(f"Error cleaning up sandbox {session_id}: {str(e)}")
+def run_sandbox_reaper(stop_event: threading.Event):
+    """Call cleanup_sandboxes every REAPER_INTERVAL seconds until stop_event is set"""
+    while not stop_event.wait(REAPER_INTERVAL):
+        try:
+            cleanup_sandboxes()
+        except Exception as e:
+            print(f"Error in sandbox reaper: {str(e)}")
+
+
+def touch_sandbox(session_hash: str):
+    """Mark the sandbox of a session as used now, so that the reaper keeps it"""
+    with SANDBOX_LOCK:
+        if session_hash in SANDBOX_METADATA:
+            SANDBOX_METADATA[session_hash]["last_accessed"] = time.time()
+
+
+def set_run_active(session_hash: str, active: bool):
+    with SANDBOX_LOCK:
+        ACTIVE_RUNS[session_hash] = ACTIVE_RUNS.get(session_hash, 0) + (
+            1 if active else -1
+        )
+        if ACTIVE_RUNS[session_hash] <= 0:
+            del ACTIVE_RUNS[session_hash]
+        if session_hash in SANDBOX_METADATA:
+            SANDBOX_METADATA[session_hash]["last_accessed"] = time.time()
 
 
 def get_or_create_sandbox(session_hash: str):
     current_time = time.time()
 
-    if (
-        session_hash in SANDBOXES
-        and session_hash in SANDBOX_METADATA
-        and current_time - SANDBOX_METADATA[session_hash]["created_at"]
-        < SANDBOX_TIMEOUT
-    ):
-        print(f"Reusing Sandbox for session {session_hash}")
-        SANDBOX_METADATA[session_hash]["last_accessed"] = current_time
-        return SANDBOXES[session_hash]
-    else:
-        print("No sandbox found, creating a new one")
+    with SANDBOX_LOCK:
+        if (
+            session_hash in SANDBOXES
+            and session_hash in SANDBOX_METADATA
+            and current_time - SANDBOX_METADATA[session_hash]["created_at"]
+            < SANDBOX_TIMEOUT
+        ):
+            print(f"Reusing Sandbox for session {session_hash}")
+            SANDBOX_METADATA[session_hash]["last_accessed"] = current_time
+            return SANDBOXES[session_hash]
+        else:
+            print("No sandbox found, creating a new one")
+        expired_desktop = SANDBOXES.pop(session_hash, None)
+        SANDBOX_METADATA.pop(session_hash, None)
 
-    if session_hash in SANDBOXES:
+    if expired_desktop is not None:
         try:
             print(f"Closing expired sandbox for session {session_hash}")
-            SANDBOXES[session_hash].kill()
+            expired_desktop.kill()
         except Exception as e:
             print(f"Error closing expired sandbox: {str(e)}")
 
     print(f"Creating new sandbox for session {session_hash}")
-    
+
     if USE_LOCAL_DESKTOP:
         print("Using local desktop")
         desktop = LocalDesktop(
@@ -158,24 +267,16 @@ def get_or_create_sandbox(session_hash: str):
         desktop.stream.start(require_auth=True)
     else:
         print("Using E2B desktop")
-        desktop = Sandbox(
-            api_key=E2B_API_KEY,
-            resolution=(WIDTH, HEIGHT),
-            dpi=96,
-            timeout=SANDBOX_TIMEOUT,
-            template="k0wmnzir0zuzye6dndlw",
-        )
-        desktop.stream.start(require_auth=True)
-        setup_cmd = """sudo mkdir -p /usr/lib/firefox-esr/distribution && echo '{"policies":{"OverrideFirstRunPage":"","OverridePostUpdatePage":"","DisableProfileImport":true,"DontCheckDefaultBrowser":true}}' | sudo tee /usr/lib/firefox-esr/distribution/policies.json > /dev/null"""
-        desktop.commands.run(setup_cmd)
+        desktop = SANDBOX_POOL.checkout()
 
     print(f"Sandbox ID for session {session_hash} is {desktop.sandbox_id}.")
 
-    SANDBOXES[session_hash] = desktop
-    SANDBOX_METADATA[session_hash] = {
-        "created_at": current_time,
-        "last_accessed": current_time,
-    }
+    with SANDBOX_LOCK:
+        SANDBOXES[session_hash] = desktop
+        SANDBOX_METADATA[session_hash] = {
+            "created_at": current_time,
+            "last_accessed": current_time,
+        }
     return desktop
 
 
@@ -187,11 +288,12 @@ def update_html(interactive_mode: bool, session_hash: str):
 
     status_class = "status-interactive" if interactive_mode else "status-view-only"
     status_text = "Interactive" if interactive_mode else "Agent running..."
-    creation_time = (
-        SANDBOX_METADATA[session_hash]["created_at"]
-        if session_hash in SANDBOX_METADATA
-        else time.time()
-    )
+    with SANDBOX_LOCK:
+        creation_time = (
+            SANDBOX_METADATA[session_hash]["created_at"]
+            if session_hash in SANDBOX_METADATA
+            else time.time()
+        )
 
     sandbox_html_content = sandbox_html_template.format(
         stream_url=stream_url,
@@ -206,12 +308,17 @@ def generate_interaction_id(session_hash: str):
     return f"{session_hash}_{int(time.time())}"
 
 
-def save_final_status(folder, status: str, summary, error_message=None) -> None:
+def save_final_status(folder, status: str, error_message=None) -> None:
+    """Record how the run ended. Its steps are already in steps.jsonl, written as they happened."""
     with open(os.path.join(folder, "metadata.jsonl"), "a") as output_file:
         output_file.write(
             "\n"
             + json.dumps(
-                {"status": status, "summary": summary, "error_message": error_message},
+                {
+                    "status": status,
+                    "error_message": error_message,
+                    "trace": "steps.jsonl",
+                },
             )
         )
 
@@ -231,6 +338,13 @@ def initialize_session(interactive_mode, request: gr.Request):
 def create_agent(data_dir, desktop):
     model = OpenRouterModel(
         model_id=os.getenv("OPENROUTER_MODEL_ID", "Qwen/Qwen2.5-VL-72B-Instruct:free"),
+        fallback_endpoints=[
+            model_id
+            for model_id in os.getenv("OPENROUTER_FALLBACK_MODEL_IDS", "").split(",")
+            if model_id
+        ],
+        hedge_requests=os.getenv("MODEL_HEDGE_REQUESTS", "").lower() in ["true", "1"],
+        response_cache=RESPONSE_CACHE,
     )
 
     # model = OpenAIServerModel(
@@ -242,6 +356,8 @@ def create_agent(data_dir, desktop):
         desktop=desktop,
         max_steps=20,
         verbosity_level=2,
+        image_encoding=ImageEncodingPolicy.from_env(),
+        enable_action_macros=os.getenv("ACTION_MACROS", "").lower() in ["true", "1"],
         # planning_interval=10,
         use_v1_prompt=True,
     )
@@ -281,10 +397,22 @@ class EnrichedGradioUI(GradioUI):
 
         # Always re-create an agent from scratch, else Qwen-VL gets confused with past history
         session_state["agent"] = create_agent(data_dir=data_dir, desktop=desktop)
+        # Each step counts as an access to the sandbox
+        session_state["agent"].step_callbacks.append(
+            lambda memory_step, agent=None: touch_sandbox(request.session_hash)
+        )
+        trace_writer = None
+        if consent_storage:
+            # Record each step as it happens, so that a crash loses at most one step
+            trace_writer = StepTraceWriter(os.path.join(data_dir, "steps.jsonl"))
+            session_state["agent"].step_callbacks.append(trace_writer)
 
         if not task_input or len(task_input) == 0:
             raise gr.Error("Task cannot be empty")
 
+        error_message = None
+        # Until the run is over, the reaper must not kill its sandbox nor move its data_dir away
+        set_run_active(request.session_hash, True)
         try:
             stored_messages.append(
                 gr.ChatMessage(
@@ -301,8 +429,7 @@ class EnrichedGradioUI(GradioUI):
                         )
                     )
 
-            screenshot_bytes = session_state["agent"].desktop.screenshot(format="bytes")
-            initial_screenshot = Image.open(BytesIO(screenshot_bytes))
+            initial_screenshot = session_state["agent"].grab_screen()
             for msg in stream_to_gradio(
                 session_state["agent"],
                 task=task_input,
@@ -314,6 +441,7 @@ class EnrichedGradioUI(GradioUI):
                     and isinstance(msg, gr.ChatMessage)
                     and msg.content == "-----"
                 ):  # Append the last screenshot before the end of step
+                    session_state["agent"].flush_screenshots()
                     stored_messages.append(
                         gr.ChatMessage(
                             role="assistant",
@@ -358,12 +486,16 @@ class EnrichedGradioUI(GradioUI):
             status = "failed"
             yield stored_messages
         finally:
-            if consent_storage:
-                summary = get_agent_summary_erase_images(session_state["agent"])
-                save_final_status(
-                    data_dir, status, summary=summary, error_message=error_message
-                )
-                print("SAVING FINAL STATUS", data_dir, status, summary, error_message)
+            try:
+                # Agents are re-created for each task, while the sandbox stays with the session
+                session_state["agent"].close(kill_desktop=False)
+                if trace_writer:
+                    trace_writer.close()
+                if consent_storage:
+                    save_final_status(data_dir, status, error_message=error_message)
+                    print("SAVING FINAL STATUS", data_dir, status, error_message)
+            finally:
+                set_run_active(request.session_hash, False)
 
 
 theme = gr.themes.Default(
@@ -511,7 +643,7 @@ _Please note that we store the task logs by default so **do not write any person
     def upload_interaction_logs(session: gr.Request):
         data_dirs = []
         for interaction_id in list(
-            INTERACTION_IDS_PER_SESSION_HASH[session.session_hash].keys()
+            INTERACTION_IDS_PER_SESSION_HASH.get(session.session_hash, {}).keys()
         ):
             data_dir = os.path.join(TMP_DIR, interaction_id)
             if os.path.exists(data_dir):
@@ -520,7 +652,7 @@ _Please note that we store the task logs by default so **do not write any person
                     interaction_id
                 ]
 
-        upload_to_hf_and_remove(data_dirs)
+        LOG_UPLOADER.enqueue(data_dirs)
 
     demo.load(
         fn=lambda: True,  # dummy to trigger the load
@@ -535,5 +667,23 @@ _Please note that we store the task logs by default so **do not write any person
 
 # Launch the app
 if __name__ == "__main__":
-    Timer(60, cleanup_sandboxes).start()  # Run every minute
-    demo.launch(share=os.getenv("SHARE_GRADIO", "").lower() in ["true", "1"])
+    threading.Thread(
+        target=run_sandbox_reaper, args=(threading.Event(),), daemon=True
+    ).start()
+    LOG_UPLOADER.start()
+    if not USE_LOCAL_DESKTOP:
+        SANDBOX_POOL.start()
+    server_app, _, _ = demo.launch(
+        share=os.getenv("SHARE_GRADIO", "").lower() in ["true", "1"],
+        prevent_thread_lock=True,
+    )
+    # Prometheus scrape endpoint, served next to the Gradio app
+    server_app.add_api_route(
+        "/metrics",
+        lambda: PlainTextResponse(
+            render_metrics(), media_type="text/plain; version=0.0.4"
+        ),
+        methods=["GET"],
+        include_in_schema=False,
+    )
+    demo.block_thread()
@@ -1,14 +1,29 @@
+import asyncio
+import base64
+import csv
+import hashlib
+import json
 import os
+import random
+import queue
+import re
+import shlex
+import threading
 import time
 import unicodedata
-from datetime import datetime
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from io import BytesIO
 from time import sleep
 from typing import Any, Dict, List, Optional, Union
 
 # E2B imports
 from e2b_desktop import Sandbox
-from PIL import Image, ImageDraw
+from PIL import Image, ImageChops, ImageDraw
 
 # SmolaAgents imports
 from smolagents.models import ChatMessage, Model
@@ -17,6 +32,21 @@ from smolagents.agent_types import AgentImage
 from smolagents.memory import ActionStep, TaskStep
 from smolagents.monitoring import LogLevel
 
+from frames import (
+    compute_frame_hash,
+    downscale_frame,
+    frame_difference,
+    frames_match,
+    images_identical,
+)
+from metrics import (
+    AGENT_STEPS,
+    MODEL_CALL_SECONDS,
+    STEP_PHASE_SECONDS,
+    TOOL_CALL_SECONDS,
+    TOOL_CALLS,
+)
+
 E2B_SYSTEM_PROMPT_TEMPLATE = """You are a desktop automation assistant that can control a remote desktop environment. The current date is <<current_date>>.
 
 <action process>
@@ -125,6 +155,47 @@ In browser, ignore any sign-in popups while they don't interfere with the elemen
 </general_guidelines>
 """.replace("<<current_date>>", datetime.now().strftime("%A, %d-%B-%Y"))
 
+DEFAULT_SETTLE_MAX_WAIT = 2.5
+# Upper bound on how long to wait for the screen to settle after each tool, in seconds
+TOOL_SETTLE_MAX_WAIT = {
+    "click": 1.5,
+    "right_click": 1.0,
+    "double_click": 1.5,
+    "move_mouse": 0.5,
+    "type_text": 1.0,
+    "press_key": 1.5,
+    "go_back": 3.0,
+    "drag_and_drop": 1.0,
+    "scroll": 1.0,
+    "wait": 0.5,
+    "open_url": 5.0,
+    "find_on_page_ctrl_f": 1.0,
+    "actions": 1.5,
+}
+# Steps calling these tools are never reported as unchanged: their effect, like a few typed
+# characters, can be too small to be noticed and the model must see it
+NO_DEDUP_TOOLS = ("type_text", "press_key", "go_back", "find_on_page_ctrl_f")
+# Shorter texts are typed key by key, as pasting them would not save any time
+PASTE_MIN_LENGTH = 10
+# After a paste, screen changes at most this many pixels wide are taken for a blinking caret
+PASTE_CARET_WIDTH = 4
+# Zoomed regions are enlarged up to ZOOM_MAX_FACTOR, with their largest side at most ZOOM_MAX_DIMENSION
+ZOOM_MAX_DIMENSION = 512
+ZOOM_MAX_FACTOR = 4.0
+ZOOM_CACHE_SIZE = 16
+# Tools that can be chained by the actions tool, with a short settle between two of them
+MACRO_ACTIONS = (
+    "click",
+    "double_click",
+    "right_click",
+    "move_mouse",
+    "type_text",
+    "press_key",
+    "scroll",
+)
+MACRO_MAX_ACTIONS = 10
+MACRO_SETTLE_MAX_WAIT = 0.5
+
 
 def draw_marker_on_image(image_copy, click_coordinates):
     x, y = click_coordinates
@@ -156,6 +227,110 @@ def get_agent_summary_erase_images(agent):
     return agent.write_memory_to_messages()
 
 
+class ImageEncodingPolicy:
+    """How screenshots are encoded before being sent to the model"""
+
+    SUPPORTED_FORMATS = ("PNG", "JPEG", "WEBP")
+
+    def __init__(
+        self,
+        format: str = "PNG",
+        quality: int = 85,
+        max_dimension: Optional[int] = None,
+        grayscale: bool = False,
+    ):
+        self.format = format.upper().replace("JPG", "JPEG")
+        if self.format not in self.SUPPORTED_FORMATS:
+            raise ValueError(
+                f"Unsupported image format '{format}', use one of {self.SUPPORTED_FORMATS}"
+            )
+        self.quality = quality
+        self.max_dimension = max_dimension
+        self.grayscale = grayscale
+
+    @classmethod
+    def from_env(cls):
+        """Build a policy from the SCREENSHOT_* environment variables"""
+        max_dimension = os.getenv("SCREENSHOT_MAX_DIMENSION")
+        return cls(
+            format=os.getenv("SCREENSHOT_FORMAT", "PNG"),
+            quality=int(os.getenv("SCREENSHOT_QUALITY", 85)),
+            max_dimension=int(max_dimension) if max_dimension else None,
+            grayscale=os.getenv("SCREENSHOT_GRAYSCALE", "").lower() in ["true", "1"],
+        )
+
+    def get_scale(self, width: int, height: int) -> float:
+        """Factor applied to screen dimensions to get the dimensions seen by the model"""
+        if self.max_dimension and max(width, height) > self.max_dimension:
+            return self.max_dimension / max(width, height)
+        return 1.0
+
+    def prepare(self, image):
+        """Downscale and convert an image as configured, without encoding it"""
+        scale = self.get_scale(*image.size)
+        if scale != 1.0:
+            image = image.resize(
+                (round(image.width * scale), round(image.height * scale)),
+                Image.LANCZOS,
+            )
+        if self.grayscale:
+            image = image.convert("L")
+        elif image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        return image
+
+    def encode(self, image) -> bytes:
+        buffer = BytesIO()
+        self.prepare(image).save(buffer, format=self.format, quality=self.quality)
+        return buffer.getvalue()
+
+    def to_data_url(self, image) -> str:
+        encoded = base64.b64encode(self.encode(image)).decode("utf-8")
+        return f"data:image/{self.format.lower()};base64,{encoded}"
+
+
+class ScreenshotWriter:
+    """Saves screenshots to disk from a background thread, off the agent's critical path"""
+
+    def __init__(self, max_queue_size: int = 8):
+        # Bounded so that a slow disk applies backpressure instead of piling up images in memory
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def submit(self, image, path: str) -> None:
+        """Queue an image to be saved at path. The image must not be modified afterwards."""
+        self.queue.put((image, path))
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                image, path = item
+                start_time = time.perf_counter()
+                image.save(path)
+                # Off the step's critical path, so only recorded in the process-wide histogram
+                STEP_PHASE_SECONDS.observe(
+                    time.perf_counter() - start_time, phase="screenshot_save"
+                )
+            except Exception as e:
+                print(f"Error saving screenshot: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    def flush(self) -> None:
+        """Block until every queued screenshot is written"""
+        self.queue.join()
+
+    def close(self) -> None:
+        """Write remaining screenshots, then stop the worker thread"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
 class E2BVisionAgent(CodeAgent):
     """Agent for e2b desktop automation with Qwen2.5VL vision capabilities"""
 
@@ -169,14 +344,69 @@ class E2BVisionAgent(CodeAgent):
         verbosity_level: LogLevel = 2,
         planning_interval: int = None,
         use_v1_prompt: bool = False,
+        settle_mode: str = "adaptive",
+        settle_max_wait: Optional[float] = None,
+        settle_min_wait: float = 0.3,
+        settle_poll_interval: float = 0.25,
+        settle_threshold: float = 1.0,
+        settle_stable_polls: int = 2,
+        deduplicate_screenshots: bool = True,
+        image_encoding: Optional[ImageEncodingPolicy] = None,
+        typing_mode: str = "paste",
+        typing_delay_ms: int = 75,
+        enable_action_macros: bool = False,
+        macro_abort_threshold: float = 20.0,
         **kwargs,
     ):
         self.desktop = desktop
         self.data_dir = data_dir
         self.planning_interval = planning_interval
+        # Screen settle detection: "adaptive" polls until frames stop changing, "fixed" always sleeps settle_max_wait
+        if settle_mode not in ("adaptive", "fixed"):
+            raise ValueError(
+                f"settle_mode should be 'adaptive' or 'fixed', got '{settle_mode}'"
+            )
+        self.settle_mode = settle_mode
+        self.settle_max_wait = settle_max_wait
+        self.settle_min_wait = settle_min_wait
+        self.settle_poll_interval = settle_poll_interval
+        self.settle_threshold = settle_threshold
+        self.settle_stable_polls = settle_stable_polls
+        # Per-step measurements, keyed by step number. Phase durations go under "timings".
+        self.step_metrics: Dict[int, Dict[str, Any]] = {}
+        # Unchanged screens are not saved again nor re-sent to the model
+        self.deduplicate_screenshots = deduplicate_screenshots
+        self.last_screenshot_frame = None
+        self.last_screenshot_path = None
+        self.screenshot_writer = ScreenshotWriter()
+        # Typing: "paste" goes through the clipboard and falls back to "keys", which types key by key
+        if typing_mode not in ("paste", "keys"):
+            raise ValueError(
+                f"typing_mode should be 'paste' or 'keys', got '{typing_mode}'"
+            )
+        self.typing_mode = typing_mode
+        self.typing_delay_ms = typing_delay_ms
+        # Opt-in "actions" tool chaining several actions in one step. A mean frame difference
+        # above macro_abort_threshold (out of 255) between two actions stops the chain.
+        self.enable_action_macros = enable_action_macros
+        self.macro_abort_threshold = macro_abort_threshold
+        # Latest unmarked frame, which the zoom tool crops from
+        self.last_frame = None
+        self.last_frame_id = 0
+        self.crop_cache = OrderedDict()
+        self.pending_zoom = None
         # Initialize Desktop
         self.width, self.height = self.desktop.get_screen_size()
+        self.grab_pil_frames = "pil" in getattr(self.desktop, "screenshot_formats", ())
         print(f"Screen size: {self.width}x{self.height}")
+        # The model sees screenshots through the encoding policy, possibly downscaled:
+        # tools map its coordinates back to true desktop pixels
+        self.image_encoding = image_encoding or ImageEncodingPolicy()
+        self.model_scale = self.image_encoding.get_scale(self.width, self.height)
+        self.model_width = round(self.width * self.model_scale)
+        self.model_height = round(self.height * self.model_scale)
+        if self.model_scale != 1.0:
+            print(f"Model sees screenshots at {self.model_width}x{self.model_height}")
 
         # Set up temp directory
         os.makedirs(self.data_dir, exist_ok=True)
@@ -194,8 +424,8 @@ class E2BVisionAgent(CodeAgent):
             **kwargs,
         )
         self.prompt_templates["system_prompt"] = E2B_SYSTEM_PROMPT_TEMPLATE.replace(
-            "<<resolution_x>>", str(self.width)
-        ).replace("<<resolution_y>>", str(self.height))
+            "<<resolution_x>>", str(self.model_width)
+        ).replace("<<resolution_y>>", str(self.model_height))
 
         # Add screen info to state
         self.state["screen_width"] = self.width
@@ -206,6 +436,37 @@ class E2BVisionAgent(CodeAgent):
         self._setup_desktop_tools()
         self.step_callbacks.append(self.take_screenshot_callback)
 
+    def to_screen_coordinates(self, x: int, y: int):
+        """Map coordinates from the model's screenshot space to desktop pixels"""
+        screen_x = min(max(round(x / self.model_scale), 0), self.width - 1)
+        screen_y = min(max(round(y / self.model_scale), 0), self.height - 1)
+        return screen_x, screen_y
+
+    def to_model_coordinates(self, x: int, y: int):
+        """Map desktop pixel coordinates to the model's screenshot space"""
+        return round(x * self.model_scale), round(y * self.model_scale)
+
+    def write_memory_to_messages(self, summary_mode: Optional[bool] = False):
+        """Same as the base agent, with images encoded according to self.image_encoding"""
+        with self.span("memory_to_messages"):
+            messages = super().write_memory_to_messages(summary_mode=summary_mode)
+        image_bytes = 0
+        with self.span("image_encoding"):
+            for message in messages:
+                if not isinstance(message.get("content"), list):
+                    continue
+                for element in message["content"]:
+                    if isinstance(element, dict) and element.get("type") == "image":
+                        data_url = self.image_encoding.to_data_url(element.pop("image"))
+                        image_bytes += len(data_url)
+                        element["type"] = "image_url"
+                        element["image_url"] = {"url": data_url}
+        if image_bytes:
+            self.step_metrics.setdefault(self.step_number, {})[
+                "model_image_bytes"
+            ] = image_bytes
+        return messages
+
     def _setup_desktop_tools(self):
         """Register all desktop tools"""
 
@@ -217,9 +478,10 @@ class E2BVisionAgent(CodeAgent):
                 x: The x coordinate (horizontal position)
                 y: The y coordinate (vertical position)
             """
-            self.desktop.move_mouse(x, y)
+            screen_x, screen_y = self.to_screen_coordinates(x, y)
+            self.desktop.move_mouse(screen_x, screen_y)
             self.desktop.left_click()
-            self.click_coordinates = [x, y]
+            self.click_coordinates = [screen_x, screen_y]
             self.logger.log(f"Clicked at coordinates ({x}, {y})")
             return f"Clicked at coordinates ({x}, {y})"
 
@@ -231,9 +493,10 @@ class E2BVisionAgent(CodeAgent):
                 x: The x coordinate (horizontal position)
                 y: The y coordinate (vertical position)
             """
-            self.desktop.move_mouse(x, y)
+            screen_x, screen_y = self.to_screen_coordinates(x, y)
+            self.desktop.move_mouse(screen_x, screen_y)
             self.desktop.right_click()
-            self.click_coordinates = [x, y]
+            self.click_coordinates = [screen_x, screen_y]
             self.logger.log(f"Right-clicked at coordinates ({x}, {y})")
             return f"Right-clicked at coordinates ({x}, {y})"
 
@@ -245,9 +508,10 @@ class E2BVisionAgent(CodeAgent):
                 x: The x coordinate (horizontal position)
                 y: The y coordinate (vertical position)
             """
-            self.desktop.move_mouse(x, y)
+            screen_x, screen_y = self.to_screen_coordinates(x, y)
+            self.desktop.move_mouse(screen_x, screen_y)
             self.desktop.double_click()
-            self.click_coordinates = [x, y]
+            self.click_coordinates = [screen_x, screen_y]
             self.logger.log(f"Double-clicked at coordinates ({x}, {y})")
             return f"Double-clicked at coordinates ({x}, {y})"
 
@@ -259,7 +523,7 @@ class E2BVisionAgent(CodeAgent):
                 x: The x coordinate (horizontal position)
                 y: The y coordinate (vertical position)
             """
-            self.desktop.move_mouse(x, y)
+            self.desktop.move_mouse(*self.to_screen_coordinates(x, y))
             self.logger.log(f"Moved mouse to coordinates ({x}, {y})")
             return f"Moved mouse to coordinates ({x}, {y})"
 
@@ -278,7 +542,7 @@ class E2BVisionAgent(CodeAgent):
                 text: The text to type
             """
             clean_text = normalize_text(text)
-            self.desktop.write(clean_text, delay_in_ms=75)
+            self.write_text(clean_text)
             self.logger.log(f"Typed text: '{clean_text}'")
             return f"Typed text: '{clean_text}'"
 
@@ -313,7 +577,10 @@ class E2BVisionAgent(CodeAgent):
                 x2: end x coordinate
                 y2: end y coordinate
             """
-            self.desktop.drag([x1, y1], [x2, y2])
+            self.desktop.drag(
+                list(self.to_screen_coordinates(x1, y1)),
+                list(self.to_screen_coordinates(x2, y2)),
+            )
             message = f"Dragged and dropped from [{x1}, {y1}] to [{x2}, {y2}]"
             self.logger.log(message)
             return message
@@ -328,7 +595,7 @@ class E2BVisionAgent(CodeAgent):
                 direction: The direction to scroll ("up" or "down"), defaults to "down". For zoom, "up" zooms in, "down" zooms out.
                 amount: The amount to scroll. A good amount is 1 or 2.
             """
-            self.desktop.move_mouse(x, y)
+            self.desktop.move_mouse(*self.to_screen_coordinates(x, y))
             self.desktop.scroll(direction=direction, amount=amount)
             message = f"Scrolled {direction} by {amount}"
             self.logger.log(message)
@@ -372,7 +639,7 @@ class E2BVisionAgent(CodeAgent):
             self.desktop.press(["ctrl", "f"])
             time.sleep(0.3)
             clean_text = normalize_text(search_string)
-            self.desktop.write(clean_text, delay_in_ms=75)
+            self.write_text(clean_text)
             time.sleep(0.3)
             self.desktop.press("enter")
             time.sleep(0.3)
@@ -381,6 +648,22 @@ class E2BVisionAgent(CodeAgent):
             self.logger.log(output_message)
             return output_message
 
+        @tool
+        def zoom(x: int, y: int, width: int, height: int) -> str:
+            """
+            Shows an enlarged view of a region of the latest screenshot, without acting on the desktop nor taking a new screenshot. Use it on its own to read small text or to target precisely in dense menus, then convert what you see back to screen coordinates as explained in its output.
+            Args:
+                x: The x coordinate of the top-left corner of the region
+                y: The y coordinate of the top-left corner of the region
+                width: The width of the region
+                height: The height of the region
+            """
+            zoomed_image, factor = self.get_zoomed_region(x, y, width, height)
+            self.pending_zoom = zoomed_image
+            message = f"Zoomed {factor:.2f}x on the region at ({x}, {y}) of size {width}x{height}. A point (u, v) in the zoomed image is at screen coordinates ({x} + u / {factor:.2f}, {y} + v / {factor:.2f})."
+            self.logger.log(message)
+            return message
+
         # Register the tools
         self.tools["click"] = click
         self.tools["right_click"] = right_click
@@ -394,100 +677,1119 @@ class E2BVisionAgent(CodeAgent):
         self.tools["go_back"] = go_back
         self.tools["drag_and_drop"] = drag_and_drop
         self.tools["find_on_page_ctrl_f"] = find_on_page_ctrl_f
+        self.tools["zoom"] = zoom
 
-    def take_screenshot_callback(self, memory_step: ActionStep, agent=None) -> None:
-        """Callback that takes a screenshot + memory snapshot after a step completes"""
-        self.logger.log("Analyzing screen content...")
+        for name, desktop_tool in self.tools.items():
+            if name != "final_answer":
+                desktop_tool.forward = self.time_tool(name, desktop_tool.forward)
+
+        if self.enable_action_macros:
+
+            @tool
+            def actions(steps: list) -> str:
+                """
+                Performs several actions in a row, then takes a single screenshot. Use it for routine sequences whose targets are all visible on the current screenshot, like filling a form field by field. Each step is a dict with an "action" key among click, double_click, right_click, move_mouse, type_text, press_key and scroll, plus the arguments of that tool, e.g. [{"action": "click", "x": 120, "y": 300}, {"action": "type_text", "text": "John"}, {"action": "press_key", "key": "tab"}]. The sequence stops early if the screen changes a lot in the middle, for instance when a new page or dialog opens.
+                Args:
+                    steps: The list of actions to perform, in order.
+                """
+                return self.run_action_macro(steps)
+
+            # Not timed as a whole: each action is timed as its own tool call
+            self.tools["actions"] = actions
+
+    def validate_action_macro(self, steps) -> List[tuple]:
+        """Check every step of an action macro before running any of them.
+        Returns (tool name, arguments) pairs."""
+        if not isinstance(steps, list) or not steps:
+            raise ValueError("steps should be a non-empty list of actions")
+        if len(steps) > MACRO_MAX_ACTIONS:
+            raise ValueError(f"At most {MACRO_MAX_ACTIONS} actions can be chained")
+        validated = []
+        for i, step in enumerate(steps):
+            if not isinstance(step, dict) or step.get("action") not in MACRO_ACTIONS:
+                raise ValueError(
+                    f"Step {i} should be a dict with an 'action' among {MACRO_ACTIONS}, got {step}"
+                )
+            name = step["action"]
+            arguments = {key: value for key, value in step.items() if key != "action"}
+            inputs = self.tools[name].inputs
+            unknown = set(arguments) - set(inputs)
+            missing = {
+                key
+                for key, schema in inputs.items()
+                if not schema.get("nullable") and key not in arguments
+            }
+            if unknown or missing:
+                raise ValueError(
+                    f"Step {i} ({name}) has unknown arguments {sorted(unknown)} or misses {sorted(missing)}"
+                )
+            validated.append((name, arguments))
+        return validated
+
+    def run_action_macro(self, steps) -> str:
+        """Run validated actions with short settles in between, stopping early when
+        the screen changes much more than a form interaction would"""
+        validated = self.validate_action_macro(steps)
+        previous_frame = downscale_frame(self.grab_screen())
+        outputs = []
+        for i, (name, arguments) in enumerate(validated):
+            outputs.append(self.tools[name](**arguments))
+            if i == len(validated) - 1:
+                break
+            with self.span("settle"):
+                image, _ = self.wait_for_screen_settle(
+                    MACRO_SETTLE_MAX_WAIT, previous_frame
+                )
+            frame = downscale_frame(image)
+            difference = frame_difference(previous_frame, frame)
+            previous_frame = frame
+            if difference > self.macro_abort_threshold:
+                message = (
+                    f"Performed {i + 1} of {len(validated)} actions: "
+                    + "; ".join(outputs)
+                    + f". Stopped because the screen changed a lot after action {i + 1} ({name}): check the new screenshot before doing the remaining actions."
+                )
+                self.logger.log(message)
+                return message
+        message = f"Performed {len(validated)} actions: " + "; ".join(outputs)
+        self.logger.log(message)
+        return message
+
+    def record_timing(
+        self, phase: str, seconds: float, step_number: Optional[int] = None
+    ) -> None:
+        """Add the duration of a phase to the step timings and to the phase histogram"""
+        if step_number is None:
+            # Before the run starts, timings go to step 0
+            step_number = getattr(self, "step_number", 0)
+        timings = self.step_metrics.setdefault(step_number, {}).setdefault(
+            "timings", {}
+        )
+        timings[phase] = timings.get(phase, 0.0) + seconds
+        STEP_PHASE_SECONDS.observe(seconds, phase=phase)
+
+    @contextmanager
+    def span(self, phase: str, step_number: Optional[int] = None):
+        """Time the enclosed block as a phase of the current step.
+        Spans can nest: "settle" includes the screenshots fetched while polling."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_timing(phase, time.perf_counter() - start_time, step_number)
+
+    def time_tool(self, name: str, forward):
+        """Wrap a tool's forward method to time each of its calls"""
+
+        def timed_forward(*args, **kwargs):
+            start_time = time.perf_counter()
+            status = "error"
+            try:
+                result = forward(*args, **kwargs)
+                status = "success"
+                return result
+            finally:
+                duration = time.perf_counter() - start_time
+                self.record_timing("tools", duration)
+                step_metrics = self.step_metrics[getattr(self, "step_number", 0)]
+                step_metrics.setdefault("tool_calls", []).append(
+                    {"tool": name, "seconds": duration, "status": status}
+                )
+                TOOL_CALL_SECONDS.observe(duration, tool=name)
+                TOOL_CALLS.inc(tool=name, status=status)
+
+        return timed_forward
+
+    def export_timings(self, path: str) -> None:
+        """Write the phase timings of every step, as CSV if path ends with .csv, else as JSON"""
+        rows = [
+            {"step_number": step_number, "phase": phase, "seconds": seconds}
+            for step_number, metrics in sorted(self.step_metrics.items())
+            for phase, seconds in metrics.get("timings", {}).items()
+        ]
+        with open(path, "w", newline="") as f:
+            if path.endswith(".csv"):
+                writer = csv.DictWriter(
+                    f, fieldnames=["step_number", "phase", "seconds"]
+                )
+                writer.writeheader()
+                writer.writerows(rows)
+            else:
+                json.dump(rows, f, indent=2)
+
+    def grab_screen(self):
+        """Take a screenshot as a PIL image"""
+        if self.grab_pil_frames:
+            # No PNG round trip when the desktop hands out frames directly
+            with self.span("screenshot_fetch"):
+                return self.desktop.screenshot(format="pil")
+        with self.span("screenshot_fetch"):
+            screenshot_bytes = self.desktop.screenshot(format="bytes")
+        with self.span("screenshot_decode"):
+            image = Image.open(BytesIO(screenshot_bytes))
+            image.load()
+        return image
+
+    def write_text(self, text: str) -> None:
+        """Type text at the cursor position, pasting it when typing_mode allows it"""
+        if (
+            self.typing_mode == "paste"
+            and len(text) >= PASTE_MIN_LENGTH
+            and self.paste_text(text)
+        ):
+            return
+        self.desktop.write(text, delay_in_ms=self.typing_delay_ms)
+
+    def paste_text(self, text: str) -> bool:
+        """Paste text through the desktop clipboard.
+        Returns False if the clipboard could not be filled or if the paste had no visible effect,
+        for instance in fields that reject paste. The whole screen is compared, as the focused
+        field may be anywhere: the find bar, or a field reached with tab or ctrl+L."""
+        commands = getattr(self.desktop, "commands", None)
+        if not hasattr(commands, "run"):
+            return False
+        screen_before = self.grab_screen().convert("RGB")
+        try:
+            # xclip keeps running to serve the clipboard: detach it so the command returns
+            commands.run(
+                f"printf %s {shlex.quote(text)} | xclip -selection clipboard >/dev/null 2>&1 &",
+                envs={"DISPLAY": ":0"},
+            )
+            if not self.clipboard_holds(text):
+                print("Clipboard does not hold the text, typing instead")
+                return False
+        except Exception as e:
+            print(f"Could not fill the clipboard, typing instead: {str(e)}")
+            return False
+        self.desktop.press(["ctrl", "v"])
+        time.sleep(0.2)
+        # Compared pixel by pixel: a few pasted characters are too small for the frame hash
+        screen_after = self.grab_screen().convert("RGB")
+        bbox = ImageChops.difference(screen_before, screen_after).getbbox()
+        if bbox is None or bbox[2] - bbox[0] <= PASTE_CARET_WIDTH:
+            print("Paste had no visible effect, typing instead")
+            return False
+        return True
+
+    def clipboard_holds(self, text: str, timeout: float = 1.0) -> bool:
+        """Whether the clipboard holds text, waiting for the detached xclip to take it"""
+        start_time = time.time()
+        while True:
+            result = self.desktop.commands.run(
+                "xclip -selection clipboard -o 2>/dev/null", envs={"DISPLAY": ":0"}
+            )
+            if getattr(result, "stdout", result) == text:
+                return True
+            if time.time() - start_time >= timeout:
+                return False
+            time.sleep(0.1)
 
+    def get_zoomed_region(self, x: int, y: int, width: int, height: int):
+        """Enlarged crop of the latest frame, for a region given in model coordinates.
+        Returns the image and its scale relative to model coordinates."""
+        if self.last_frame is None:
+            raise ValueError("No screenshot has been taken yet, nothing to zoom on")
+        left, top = self.to_screen_coordinates(x, y)
+        right, bottom = self.to_screen_coordinates(x + width, y + height)
+        if right <= left or bottom <= top:
+            raise ValueError("The zoom region must have a positive width and height")
+
+        cache_key = (self.last_frame_id, left, top, right, bottom)
+        if cache_key in self.crop_cache:
+            self.crop_cache.move_to_end(cache_key)
+            zoomed_image = self.crop_cache[cache_key]
+        else:
+            crop = self.last_frame.crop((left, top, right, bottom))
+            max_dimension = min(
+                ZOOM_MAX_DIMENSION,
+                self.image_encoding.max_dimension or ZOOM_MAX_DIMENSION,
+            )
+            factor = min(ZOOM_MAX_FACTOR, max_dimension / max(crop.size))
+            zoomed_image = crop.resize(
+                (round(crop.width * factor), round(crop.height * factor)),
+                Image.LANCZOS,
+            )
+            self.crop_cache[cache_key] = zoomed_image
+            if len(self.crop_cache) > ZOOM_CACHE_SIZE:
+                self.crop_cache.popitem(last=False)
+        return zoomed_image, zoomed_image.width / width
+
+    def get_step_code(self, memory_step: ActionStep) -> str:
+        if memory_step.tool_calls:
+            return str(getattr(memory_step.tool_calls[0], "arguments", "") or "")
+        return ""
+
+    def get_called_tools(self, memory_step: ActionStep) -> set:
+        """Names of the tools called in the code of this step"""
+        return set(re.findall(r"\b(\w+)\s*\(", self.get_step_code(memory_step)))
+
+    def may_deduplicate(self, memory_step: ActionStep) -> bool:
+        """Whether the screenshot of this step can be reported as unchanged. Typing steps never are,
+        including action macros whose steps name a typing action."""
+        if not self.deduplicate_screenshots:
+            return False
+        code = self.get_step_code(memory_step)
+        return not any(re.search(rf"\b{name}\b", code) for name in NO_DEDUP_TOOLS)
+
+    def get_settle_max_wait(self, memory_step: ActionStep) -> float:
+        """Longest settle wait among the tools called in this step"""
+        if self.settle_max_wait is not None:
+            return self.settle_max_wait
+        waits = [
+            TOOL_SETTLE_MAX_WAIT[name]
+            for name in self.get_called_tools(memory_step)
+            if name in TOOL_SETTLE_MAX_WAIT
+        ]
+        return max(waits) if waits else DEFAULT_SETTLE_MAX_WAIT
+
+    def wait_for_screen_settle(self, max_wait: float, reference_frame=None):
+        """Poll screenshots until settle_stable_polls consecutive polls match, or until max_wait
+        has elapsed. If reference_frame, the downscaled screen before the action, is given, the
+        screen must also differ from it: right after a click, a page load may not have started yet.
+        Returns the last screenshot taken and the time spent waiting."""
+        start_time = time.time()
+        if self.settle_mode == "fixed":
+            time.sleep(max_wait)
+            return self.grab_screen(), time.time() - start_time
+
+        deadline = start_time + max_wait
+        time.sleep(min(self.settle_min_wait, max_wait))
+        image = self.grab_screen()
+        previous_frame = downscale_frame(image)
+        stable_polls = 0
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            # The last poll is taken at the deadline, not one interval after it
+            time.sleep(min(self.settle_poll_interval, remaining))
+            image = self.grab_screen()
+            frame = downscale_frame(image)
+            if frame_difference(previous_frame, frame) <= self.settle_threshold:
+                stable_polls += 1
+            else:
+                stable_polls = 0
+            previous_frame = frame
+            changed = (
+                reference_frame is None
+                or frame_difference(reference_frame, frame) > self.settle_threshold
+            )
+            if changed and stable_polls >= self.settle_stable_polls:
+                break
+        return image, time.time() - start_time
+
+    def capture_step_screenshot(self, memory_step: ActionStep):
+        """Wait for the screen to settle, then take and save the step screenshot.
+        Returns the marked image for the model, or None if the screen is unchanged,
+        and whether the screen is unchanged."""
         current_step = memory_step.step_number
 
-        time.sleep(2.5)  # Let things happen on the desktop
-        screenshot_bytes = self.desktop.screenshot(format="bytes")
-        image = Image.open(BytesIO(screenshot_bytes))
+        # Let things happen on the desktop
+        max_wait = self.get_settle_max_wait(memory_step)
+        # The latest frame is what the model acted on
+        reference_frame = (
+            downscale_frame(self.last_frame) if self.last_frame is not None else None
+        )
+        with self.span("settle"):
+            image, settle_time = self.wait_for_screen_settle(max_wait, reference_frame)
+        self.step_metrics.setdefault(current_step, {}).update(
+            {"settle_time": settle_time, "settle_max_wait": max_wait}
+        )
+        self.logger.log(f"Screen settled in {settle_time:.2f}s (max {max_wait:.1f}s)")
+        self.last_frame = image
 
-        # Create a filename with step number
-        screenshot_path = os.path.join(self.data_dir, f"step_{current_step:03d}.png")
-        image.save(screenshot_path)
+        # Compared pixel by pixel: a hash would miss small changes like a few typed characters
+        with self.span("frame_compare"):
+            screen_unchanged = (
+                self.last_screenshot_path is not None
+                and self.may_deduplicate(memory_step)
+                and images_identical(self.last_screenshot_frame, image)
+            )
 
-        image_copy = image.copy()
+        if screen_unchanged:
+            # Point to the previous file instead of writing an identical one
+            screenshot_path = self.last_screenshot_path
+            image_copy = None
+            print(f"Screen unchanged at step {current_step}, reusing {screenshot_path}")
+        else:
+            # Create a filename with step number
+            screenshot_path = os.path.join(
+                self.data_dir, f"step_{current_step:03d}.png"
+            )
+            # Blocks only when the writer is behind
+            with self.span("screenshot_queue"):
+                self.screenshot_writer.submit(image, screenshot_path)
+            self.last_frame_id += 1
 
-        if getattr(self, "click_coordinates", None):
-            print("DRAWING MARKER")
-            image_copy = draw_marker_on_image(image_copy, self.click_coordinates)
+            with self.span("marker"):
+                image_copy = image.copy()
 
-        self.last_marked_screenshot = AgentImage(screenshot_path)
-        print(f"Saved screenshot for step {current_step} to {screenshot_path}")
+                if getattr(self, "click_coordinates", None):
+                    print("DRAWING MARKER")
+                    image_copy = draw_marker_on_image(
+                        image_copy, self.click_coordinates
+                    )
 
-        for previous_memory_step in (
-            agent.memory.steps
-        ):  # Remove previous screenshots from logs for lean processing
-            if (
-                isinstance(previous_memory_step, ActionStep)
-                and previous_memory_step.step_number <= current_step - 1
-            ):
-                previous_memory_step.observations_images = None
-            elif isinstance(previous_memory_step, TaskStep):
-                previous_memory_step.task_images = None
+            self.last_marked_screenshot = AgentImage(screenshot_path)
+            self.last_screenshot_path = screenshot_path
+            self.last_screenshot_frame = image
+            print(f"Queued screenshot for step {current_step} to {screenshot_path}")
+        self.step_metrics[current_step].update(
+            {"screenshot_ref": screenshot_path, "screen_unchanged": screen_unchanged}
+        )
+        return image_copy, screen_unchanged
+
+    def take_screenshot_callback(self, memory_step: ActionStep, agent=None) -> None:
+        """Callback that takes a screenshot + memory snapshot after a step completes"""
+        with self.span("callback", memory_step.step_number):
+            self.update_step_memory(memory_step, agent)
+        AGENT_STEPS.inc()
+
+    def update_step_memory(self, memory_step: ActionStep, agent) -> None:
+        self.logger.log("Analyzing screen content...")
+
+        current_step = memory_step.step_number
+        model_call_duration = getattr(self.model, "last_call_duration", None)
+        if model_call_duration is not None:
+            self.record_timing("model_call", model_call_duration, current_step)
+            self.model.last_call_duration = None
+
+        desktop_tools = set(self.tools) - {"zoom", "final_answer"}
+        if self.pending_zoom is not None and (
+            self.get_called_tools(memory_step) & desktop_tools
+        ):
+            # Other actions may have changed the screen: show it rather than a crop of the old one
+            self.pending_zoom = None
+            zoom_message = "\nThe zoom was ignored because this step also acted on the desktop: call zoom on its own."
+            memory_step.observations = (memory_step.observations or "") + zoom_message
+
+        if self.pending_zoom is not None:
+            # The zoom tool works on the last stored frame: no need to wait nor take a new screenshot
+            image_copy = self.pending_zoom
+            self.pending_zoom = None
+            screen_unchanged = False
+            self.step_metrics.setdefault(current_step, {})["zoom"] = True
+            # The model's latest image is now the crop: the next screenshot must not be reported
+            # as unchanged from a frame it no longer sees
+            self.last_screenshot_path = None
+            self.last_screenshot_frame = None
+        else:
+            image_copy, screen_unchanged = self.capture_step_screenshot(memory_step)
+
+        # When the screen is unchanged, the latest screenshot in memory stays visible to the model
+        with self.span("memory_pruning", current_step):
+            image_step_to_keep = (
+                self.get_latest_image_step(agent) if screen_unchanged else None
+            )
+            for previous_memory_step in (
+                agent.memory.steps
+            ):  # Remove previous screenshots from logs for lean processing
+                if previous_memory_step is image_step_to_keep:
+                    pass
+                elif (
+                    isinstance(previous_memory_step, ActionStep)
+                    and previous_memory_step.step_number <= current_step - 1
+                ):
+                    previous_memory_step.observations_images = None
+                elif isinstance(previous_memory_step, TaskStep):
+                    previous_memory_step.task_images = None
 
-            if (
-                isinstance(previous_memory_step, ActionStep)
-                and previous_memory_step.step_number == current_step - 1
-            ):
                 if (
-                    previous_memory_step.tool_calls
-                    and getattr(previous_memory_step.tool_calls[0], "arguments", None)
-                    and memory_step.tool_calls
-                    and getattr(memory_step.tool_calls[0], "arguments", None)
+                    isinstance(previous_memory_step, ActionStep)
+                    and previous_memory_step.step_number == current_step - 1
                 ):
                     if (
-                        previous_memory_step.tool_calls[0].arguments
-                        == memory_step.tool_calls[0].arguments
+                        previous_memory_step.tool_calls
+                        and getattr(
+                            previous_memory_step.tool_calls[0], "arguments", None
+                        )
+                        and memory_step.tool_calls
+                        and getattr(memory_step.tool_calls[0], "arguments", None)
                     ):
-                        memory_step.observations += "\nWARNING: You've executed the same action several times in a row. MAKE SURE TO NOT UNNECESSARILY REPEAT ACTIONS."
+                        if (
+                            previous_memory_step.tool_calls[0].arguments
+                            == memory_step.tool_calls[0].arguments
+                        ):
+                            memory_step.observations += "\nWARNING: You've executed the same action several times in a row. MAKE SURE TO NOT UNNECESSARILY REPEAT ACTIONS."
 
-        # Add the marker-edited image to the current memory step
-        memory_step.observations_images = [image_copy]
+        if screen_unchanged:
+            unchanged_message = "\nThe screen is unchanged since the previous screenshot, which is still the latest one."
+            if getattr(self, "click_coordinates", None):
+                x, y = self.to_model_coordinates(*self.click_coordinates)
+                unchanged_message += f" Your click at ({x}, {y}) had no visible effect."
+            memory_step.observations = (
+                memory_step.observations or ""
+            ) + unchanged_message
+            memory_step.observations_images = None
+        else:
+            # Add the marker-edited image to the current memory step
+            memory_step.observations_images = [image_copy]
 
         # memory_step.observations_images = [screenshot_path] # IF YOU USE THIS INSTEAD OF ABOVE, LAUNCHING A SECOND TASK BREAKS
 
         self.click_coordinates = None  # Reset click marker
 
-    def close(self):
-        """Clean up resources"""
-        if self.desktop:
+    def get_latest_image_step(self, agent):
+        """Most recent memory step that still holds a screenshot"""
+        for previous_memory_step in reversed(agent.memory.steps):
+            if isinstance(previous_memory_step, ActionStep):
+                if previous_memory_step.observations_images:
+                    return previous_memory_step
+            elif isinstance(previous_memory_step, TaskStep):
+                if previous_memory_step.task_images:
+                    return previous_memory_step
+        return None
+
+    def flush_screenshots(self):
+        """Wait until all step screenshots are written to data_dir"""
+        self.screenshot_writer.flush()
+
+    def close(self, kill_desktop: bool = True):
+        """Clean up resources: write the remaining screenshots and stop the writer thread, then kill
+        the sandbox unless kill_desktop is False, for desktops that outlive the agent"""
+        self.screenshot_writer.close()
+        if kill_desktop and self.desktop:
             print("Stopping e2b stream and killing sandbox...")
             self.desktop.stream.stop()
             self.desktop.kill()
             print("E2B sandbox terminated")
 
 
+OPENROUTER_API_BASE = "https://openrouter.ai/api/v1"
+# Maximum number of simultaneous requests to one API endpoint, across all model instances
+MODEL_MAX_CONCURRENCY = int(os.getenv("MODEL_MAX_CONCURRENCY", 8))
+MODEL_MAX_CONNECTIONS = int(os.getenv("MODEL_MAX_CONNECTIONS", 32))
+
+# Clients and concurrency limits shared by every model instance, keyed by endpoint
+SHARED_CLIENTS: Dict[tuple, Any] = {}
+ENDPOINT_SEMAPHORES: Dict[str, Any] = {}
+# Async clients and semaphores are bound to an event loop: per loop, the same dictionaries.
+# Entries go away with their loop, or once it is closed if they still reference it.
+LOOP_SHARED_OBJECTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = (
+    weakref.WeakKeyDictionary()
+)
+SHARED_CLIENTS_LOCK = threading.Lock()
+# Runs hedged model requests in parallel to the primary one
+HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=32, thread_name_prefix="model-hedge")
+
+
+class RateLimiter:
+    """Token bucket allowing on average `rate` acquisitions per second, in bursts of up to `burst`.
+    Share one instance between models to enforce a global request rate."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until a request is allowed"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            sleep(delay)
+
+
+def get_loop_shared_objects(name: str) -> dict:
+    """Dictionary of shared objects bound to the running event loop. Called with SHARED_CLIENTS_LOCK held."""
+    for loop in [loop for loop in LOOP_SHARED_OBJECTS if loop.is_closed()]:
+        del LOOP_SHARED_OBJECTS[loop]
+    loop_objects = LOOP_SHARED_OBJECTS.setdefault(asyncio.get_running_loop(), {})
+    return loop_objects.setdefault(name, {})
+
+
+def get_shared_openai_client(api_base: str, api_key: str, asynchronous: bool = False):
+    """OpenAI client shared across model instances, so that connections to an endpoint are pooled and kept alive.
+    Async clients are bound to the running event loop."""
+    key = (api_base, api_key)
+    with SHARED_CLIENTS_LOCK:
+        clients = get_loop_shared_objects("clients") if asynchronous else SHARED_CLIENTS
+        if key not in clients:
+            import httpx
+            import openai
+
+            limits = httpx.Limits(
+                max_connections=MODEL_MAX_CONNECTIONS,
+                max_keepalive_connections=MODEL_MAX_CONNECTIONS,
+                keepalive_expiry=60,
+            )
+            # Retries are handled by OpenRouterModel, with backoff shared across attempts
+            if asynchronous:
+                clients[key] = openai.AsyncOpenAI(
+                    api_key=api_key,
+                    base_url=api_base,
+                    max_retries=0,
+                    http_client=openai.DefaultAsyncHttpxClient(limits=limits),
+                )
+            else:
+                clients[key] = openai.OpenAI(
+                    api_key=api_key,
+                    base_url=api_base,
+                    max_retries=0,
+                    http_client=openai.DefaultHttpxClient(limits=limits),
+                )
+        return clients[key]
+
+
+def get_endpoint_semaphore(api_base: str, asynchronous: bool = False):
+    """Semaphore limiting concurrent requests to an endpoint to MODEL_MAX_CONCURRENCY"""
+    with SHARED_CLIENTS_LOCK:
+        semaphores = (
+            get_loop_shared_objects("semaphores")
+            if asynchronous
+            else ENDPOINT_SEMAPHORES
+        )
+        if api_base not in semaphores:
+            semaphores[api_base] = (
+                asyncio.Semaphore(MODEL_MAX_CONCURRENCY)
+                if asynchronous
+                else threading.BoundedSemaphore(MODEL_MAX_CONCURRENCY)
+            )
+        return semaphores[api_base]
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """Rate limits, timeouts, server errors and connection errors are worth retrying, client errors are not"""
+    status_code = getattr(error, "status_code", None)
+    return status_code is None or status_code in (408, 409, 429) or status_code >= 500
+
+
+def is_endpoint_error(error: Exception) -> bool:
+    """Client errors caused by the endpoint rather than by the request, like a bad API key,
+    missing credits or an unknown model: other endpoints may still answer the request"""
+    return getattr(error, "status_code", None) in (401, 402, 403, 404)
+
+
+def get_retry_delay(
+    error: Exception, attempt: int, base_delay: float = 1.0, max_delay: float = 30.0
+) -> float:
+    """Delay before the next attempt: the server's Retry-After if given, else exponential backoff with full jitter"""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), max_delay * 2)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                delay = (retry_at - datetime.now(timezone.utc)).total_seconds()
+                return min(max(delay, 0.0), max_delay * 2)
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+# Latency assumed for endpoints that failed without ever answering, so that they rank last
+ERROR_ONLY_LATENCY = 60.0
+
+
+class ModelEndpoint:
+    """A model served by an API endpoint, with live latency and error statistics"""
+
+    def __init__(
+        self,
+        model_id: str,
+        api_base: str = OPENROUTER_API_BASE,
+        api_key: Optional[str] = None,
+        window: int = 50,
+        cooldown: float = 30.0,
+    ):
+        self.model_id = model_id
+        self.api_base = api_base
+        self.api_key = api_key or os.getenv("OPENROUTER_API_KEY")
+        self.model = OpenAIServerModel(
+            model_id=model_id,
+            api_key=self.api_key,
+            api_base=api_base,
+            client=get_shared_openai_client(api_base, self.api_key),
+        )
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.cooldown = cooldown
+        self.unhealthy_until = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return f"{self.model_id}@{self.api_base}"
+
+    def record(
+        self, latency: float, success: bool, error: Optional[Exception] = None
+    ) -> None:
+        MODEL_CALL_SECONDS.observe(
+            latency, endpoint=self.name, status="success" if success else "error"
+        )
+        with self.lock:
+            self.outcomes.append(success)
+            if success:
+                self.latencies.append(latency)
+            elif (error is not None and is_endpoint_error(error)) or (
+                len(self.outcomes) >= 3 and self.error_rate() > 0.5
+            ):
+                # Misconfigured or mostly failing: stop routing to it for a while
+                self.unhealthy_until = time.time() + self.cooldown
+
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def mean_latency(self) -> float:
+        return sum(self.latencies) / len(self.latencies) if self.latencies else 0.0
+
+    def latency_quantile(self, quantile: float = 0.95) -> Optional[float]:
+        if len(self.latencies) < 10:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(quantile * len(ordered)), len(ordered) - 1)]
+
+    def is_healthy(self) -> bool:
+        return time.time() >= self.unhealthy_until
+
+    def score(self) -> float:
+        """Lower is better. Endpoints without measurements score 0 so that they get tried,
+        and endpoints that only failed so far rank after those that answered."""
+        with self.lock:
+            latency = self.mean_latency()
+            if not self.latencies and False in self.outcomes:
+                latency = ERROR_ONLY_LATENCY
+            return latency * (1 + 4 * self.error_rate())
+
+    def generate(self, messages, stop_sequences=None, **kwargs) -> ChatMessage:
+        start_time = time.time()
+        try:
+            with get_endpoint_semaphore(self.api_base):
+                message = self.model(messages, stop_sequences, **kwargs)
+        except Exception as e:
+            self.record(time.time() - start_time, success=False, error=e)
+            raise
+        self.record(time.time() - start_time, success=True)
+        return message
+
+
+# Endpoints shared by every model instance, keyed like SHARED_CLIENTS: agents are created for
+# each task, and their routing, hedging and cooldowns go on from the statistics gathered so far
+MODEL_ENDPOINTS: Dict[tuple, ModelEndpoint] = {}
+MODEL_ENDPOINTS_LOCK = threading.Lock()
+
+
+def get_model_endpoint(
+    model_id: str, api_base: str = OPENROUTER_API_BASE, api_key: Optional[str] = None
+) -> ModelEndpoint:
+    api_key = api_key or os.getenv("OPENROUTER_API_KEY")
+    key = (model_id, api_base, api_key)
+    with MODEL_ENDPOINTS_LOCK:
+        if key not in MODEL_ENDPOINTS:
+            MODEL_ENDPOINTS[key] = ModelEndpoint(model_id, api_base, api_key)
+        return MODEL_ENDPOINTS[key]
+
+
+def get_text_content(message: Dict[str, Any]) -> str:
+    content = message.get("content")
+    if isinstance(content, str):
+        return content
+    return "".join(
+        element.get("text", "")
+        for element in content or []
+        if isinstance(element, dict) and element.get("type") == "text"
+    )
+
+
+def get_last_image(messages: List[Dict[str, Any]]):
+    """Latest image of the conversation, whether a PIL image or a data URL"""
+    for message in reversed(messages):
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for element in reversed(content):
+            if not isinstance(element, dict):
+                continue
+            if element.get("type") == "image":
+                return element["image"]
+            if element.get("type") == "image_url":
+                url = element["image_url"]["url"]
+                if url.startswith("data:"):
+                    return Image.open(BytesIO(base64.b64decode(url.split(",", 1)[1])))
+    return None
+
+
+# Parts of the system prompt that change from one run to the next, replaced before hashing it
+VOLATILE_PROMPT_PATTERNS = [
+    # The current date, written as in E2B_SYSTEM_PROMPT_TEMPLATE
+    (
+        re.compile(
+            r"\b(?:Monday|Tuesday|Wednesday|Thursday|Friday|Saturday|Sunday), \d{2}-[A-Za-z]+-\d{4}\b"
+        ),
+        "<<current_date>>",
+    ),
+]
+
+
+def strip_volatile_prompt(prompt: str) -> str:
+    for pattern, replacement in VOLATILE_PROMPT_PATTERNS:
+        prompt = pattern.sub(replacement, prompt)
+    return prompt
+
+
+class ResponseCache:
+    """Model responses keyed on the task, the actions taken so far and the latest screenshot.
+
+    Re-running a task from a fresh sandbox gives near-identical first steps: their answers are
+    served from the cache instead of calling the model. Screenshots match through their frame hash,
+    so small rendering differences still hit. The least recently used entries are evicted beyond
+    max_size. If path is given, each new response is appended to it as a JSON line, and the file is
+    rewritten with the live entries only once it holds twice as many lines.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_size: int = 1000):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # (context key, frame hash) -> response content, least recently used first
+        self.entries: OrderedDict = OrderedDict()
+        # Context key -> frame hashes stored for it, to look for similar screenshots
+        self.frame_hashes: Dict[str, set] = {}
+        self.saved_lines = 0
+        self.stats: Dict[str, int] = {
+            "hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+        }
+        if path and os.path.exists(path):
+            self._load()
+
+    def _load(self) -> None:
+        with open(self.path, "r") as f:
+            text = f.read()
+        entries = []
+        for line in text.splitlines():
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A line cut short by a crash
+                continue
+        # Appending after a line cut short would corrupt the next entry too
+        self.saved_lines = len(entries) if text.endswith("\n") else None
+        try:
+            for entry in entries:
+                self._store(
+                    (entry["key"], tuple(entry["frame_hash"] or ())), entry["content"]
+                )
+        except (KeyError, TypeError):
+            print(f"Ignoring corrupted response cache {self.path}")
+            self.entries.clear()
+            self.frame_hashes.clear()
+            self.saved_lines = None
+        if self.saved_lines is None:
+            self._rewrite()
+        print(f"Loaded {len(self.entries)} cached model responses from {self.path}")
+
+    def hit_rate(self) -> float:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+    def get_context_key(self, model_id: str, messages: List[Dict[str, Any]]) -> str:
+        """Hash of the model, system prompt, task, step index and previous model outputs"""
+        system_prompt = ""
+        task = ""
+        actions = []
+        for message in messages:
+            role = str(getattr(message["role"], "value", message["role"]))
+            if role == "system":
+                system_prompt = strip_volatile_prompt(get_text_content(message))
+            elif role == "user" and not task:
+                task = get_text_content(message)
+            elif role == "assistant":
+                actions.append(get_text_content(message))
+        context = json.dumps([model_id, system_prompt, task, len(actions), actions])
+        return hashlib.sha256(context.encode()).hexdigest()
+
+    def get_frame_hash(self, messages: List[Dict[str, Any]]) -> tuple:
+        """Frame hash of the latest screenshot followed by the brightness level of each tile,
+        since the hash alone does not tell apart flat tiles of different colors"""
+        image = get_last_image(messages)
+        if image is None:
+            return ()
+        levels = [pixel // 16 for pixel in downscale_frame(image, (8, 6)).getdata()]
+        return tuple(compute_frame_hash(image, tiles=(8, 6))) + tuple(levels)
+
+    @staticmethod
+    def frame_hashes_match(hash_a: tuple, hash_b: tuple) -> bool:
+        if len(hash_a) != len(hash_b):
+            return False
+        half = len(hash_a) // 2
+        return frames_match(hash_a[:half], hash_b[:half]) and all(
+            abs(level_a - level_b) <= 1
+            for level_a, level_b in zip(hash_a[half:], hash_b[half:])
+        )
+
+    def get(self, model_id: str, messages: List[Dict[str, Any]]) -> Optional[str]:
+        key = self.get_context_key(model_id, messages)
+        frame_hash = self.get_frame_hash(messages)
+        with self.lock:
+            cache_key = (key, frame_hash)
+            if cache_key not in self.entries:
+                cache_key = next(
+                    (
+                        (key, entry_hash)
+                        for entry_hash in self.frame_hashes.get(key, ())
+                        if self.frame_hashes_match(entry_hash, frame_hash)
+                    ),
+                    None,
+                )
+            if cache_key is None:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(cache_key)
+            self.stats["hits"] += 1
+            return self.entries[cache_key]
+
+    def put(self, model_id: str, messages: List[Dict[str, Any]], content: str) -> None:
+        cache_key = (
+            self.get_context_key(model_id, messages),
+            self.get_frame_hash(messages),
+        )
+        with self.lock:
+            self._store(cache_key, content)
+            self.stats["stores"] += 1
+            if self.path:
+                self._append(cache_key, content)
+
+    def _store(self, cache_key: tuple, content: str) -> None:
+        """Add an entry, evicting the least recently used ones. Called with the lock held."""
+        key, frame_hash = cache_key
+        self.entries[cache_key] = content
+        self.entries.move_to_end(cache_key)
+        self.frame_hashes.setdefault(key, set()).add(frame_hash)
+        while len(self.entries) > self.max_size:
+            (evicted_key, evicted_hash), _ = self.entries.popitem(last=False)
+            self.frame_hashes[evicted_key].discard(evicted_hash)
+            if not self.frame_hashes[evicted_key]:
+                del self.frame_hashes[evicted_key]
+            self.stats["evictions"] += 1
+
+    def _append(self, cache_key: tuple, content: str) -> None:
+        if self.saved_lines >= 2 * max(self.max_size, len(self.entries)):
+            # Mostly evicted or overwritten entries: keep the file from growing without bound
+            self._rewrite()
+            return
+        key, frame_hash = cache_key
+        line = json.dumps(
+            {"key": key, "frame_hash": list(frame_hash), "content": content}
+        )
+        with open(self.path, "a") as f:
+            f.write(line + "\n")
+        self.saved_lines += 1
+
+    def _rewrite(self) -> None:
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            for (key, frame_hash), content in self.entries.items():
+                line = {"key": key, "frame_hash": list(frame_hash), "content": content}
+                f.write(json.dumps(line) + "\n")
+        os.replace(temp_path, self.path)
+        self.saved_lines = len(self.entries)
+
+
 class OpenRouterModel(Model):
-    """Model wrapper for Qwen2.5VL API with fallback mechanism"""
+    """Model wrapper for Qwen2.5VL API through OpenRouter, routing each call to the fastest healthy endpoint.
+
+    Parameters:
+        model_id: The primary model id.
+        fallback_endpoints: Other endpoints to route to, as model ids on api_base
+            or as dicts with "model_id", and optionally "api_base" and "api_key".
+        hedge_requests: If True, a second request is sent to the next best endpoint
+            when the first one is slower than its 95th latency percentile, and the first answer wins.
+        response_cache: If given, answers found in this cache are returned without calling the model.
+        rate_limiter: If given, every request to an endpoint, retries and hedges included, waits for it.
+    """
 
     def __init__(
         self,
         model_id: str,
+        api_base: str = OPENROUTER_API_BASE,
+        api_key: Optional[str] = None,
+        max_retries: int = 4,
+        fallback_endpoints: Optional[List[Union[str, Dict[str, str]]]] = None,
+        hedge_requests: bool = False,
+        hedge_quantile: float = 0.95,
+        response_cache: Optional[ResponseCache] = None,
+        rate_limiter: Optional[RateLimiter] = None,
     ):
         super().__init__()
         self.model_id = model_id
-        self.base_model = OpenAIServerModel(
-            model_id=model_id,
-            api_key=os.getenv("OPENROUTER_API_KEY"),
-            api_base="https://openrouter.ai/api/v1"
+        self.api_base = api_base
+        self.api_key = api_key or os.getenv("OPENROUTER_API_KEY")
+        self.max_retries = max_retries
+        self.hedge_requests = hedge_requests
+        self.hedge_quantile = hedge_quantile
+        self.response_cache = response_cache
+        self.rate_limiter = rate_limiter
+        self.endpoints = [get_model_endpoint(model_id, api_base, self.api_key)]
+        for endpoint in fallback_endpoints or []:
+            if isinstance(endpoint, str):
+                endpoint = {"model_id": endpoint}
+            self.endpoints.append(
+                get_model_endpoint(
+                    endpoint["model_id"],
+                    endpoint.get("api_base", api_base),
+                    endpoint.get("api_key", self.api_key),
+                )
+            )
+        self.base_model = self.endpoints[0].model
+        # Wall time of the latest call including retries, read by the agent's step timings
+        self.last_call_duration = None
+
+    def can_fail_over(self, error: Exception) -> bool:
+        """Whether an endpoint error leaves a healthy endpoint to send the request to"""
+        return is_endpoint_error(error) and any(
+            endpoint.is_healthy() for endpoint in self.endpoints
         )
 
+    def rank_endpoints(self) -> List[ModelEndpoint]:
+        """Healthy endpoints from fastest to slowest, or all of them if none is healthy"""
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.is_healthy()]
+        return sorted(healthy or self.endpoints, key=lambda endpoint: endpoint.score())
+
+    def wait_for_rate_limit(self) -> None:
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+    def generate_with_hedging(
+        self, endpoints: List[ModelEndpoint], messages, stop_sequences=None, **kwargs
+    ) -> ChatMessage:
+        deadline = endpoints[0].latency_quantile(self.hedge_quantile)
+        self.wait_for_rate_limit()
+        if not self.hedge_requests or len(endpoints) < 2 or deadline is None:
+            return endpoints[0].generate(messages, stop_sequences, **kwargs)
+
+        futures = {
+            HEDGE_EXECUTOR.submit(
+                endpoints[0].generate, messages, stop_sequences, **kwargs
+            ): endpoints[0]
+        }
+        done, _ = wait(futures, timeout=deadline)
+        if not done:
+            print(
+                f"No answer from {endpoints[0].name} after {deadline:.1f}s, hedging with {endpoints[1].name}"
+            )
+            self.wait_for_rate_limit()
+            futures[
+                HEDGE_EXECUTOR.submit(
+                    endpoints[1].generate, messages, stop_sequences, **kwargs
+                )
+            ] = endpoints[1]
+
+        pending = set(futures)
+        last_error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                last_error = future.exception()
+        raise last_error
+
     def generate(
         self,
         messages: List[Dict[str, Any]],
         stop_sequences: Optional[List[str]] = None,
         **kwargs,
     ) -> ChatMessage:
-        for i in range(3):
+        start_time = time.perf_counter()
+        if self.response_cache is not None:
+            cached_content = self.response_cache.get(self.model_id, messages)
+            if cached_content is not None:
+                print("Model response served from the cache")
+                self.last_input_token_count = 0
+                self.last_output_token_count = 0
+                self.last_call_duration = time.perf_counter() - start_time
+                return ChatMessage(role="assistant", content=cached_content)
+        for attempt in range(self.max_retries + 1):
             try:
-                message = self.base_model(messages, stop_sequences, **kwargs)
+                message = self.generate_with_hedging(
+                    self.rank_endpoints(), messages, stop_sequences, **kwargs
+                )
+                # Read from the response: another call may have updated the endpoint's counts since
+                usage = getattr(message.raw, "usage", None)
+                self.last_input_token_count = getattr(usage, "prompt_tokens", None)
+                self.last_output_token_count = getattr(usage, "completion_tokens", None)
+                self.last_call_duration = time.perf_counter() - start_time
+                if self.response_cache is not None and message.content:
+                    self.response_cache.put(self.model_id, messages, message.content)
                 return message
             except Exception as e:
-                if i == 2:
-                    raise Exception(f"Both endpoints failed. Last error: {e}")
-                print(f"Got an error: {e}. Sleeping for 1 second and retrying...")
-                sleep(1)
+                if attempt < self.max_retries and self.can_fail_over(e):
+                    # The failing endpoint is now unhealthy: the next attempt goes elsewhere
+                    print(f"Got an endpoint error: {e}. Trying another endpoint...")
+                    continue
+                if attempt == self.max_retries or not is_retryable_error(e):
+                    raise Exception(
+                        f"All endpoints failed after {attempt + 1} attempts. Last error: {e}"
+                    )
+                delay = get_retry_delay(e, attempt)
+                print(
+                    f"Got an error: {e}. Sleeping for {delay:.1f} seconds and retrying..."
+                )
+                sleep(delay)
+
+    async def agenerate(
+        self,
+        messages: List[Dict[str, Any]],
+        stop_sequences: Optional[List[str]] = None,
+        **kwargs,
+    ) -> ChatMessage:
+        """Asynchronous counterpart of generate, using pooled async clients"""
+        call_start_time = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            endpoint = self.rank_endpoints()[0]
+            completion_kwargs = endpoint.model._prepare_completion_kwargs(
+                messages=messages,
+                stop_sequences=stop_sequences,
+                model=endpoint.model_id,
+                custom_role_conversions=endpoint.model.custom_role_conversions,
+                convert_images_to_image_urls=True,
+                **kwargs,
+            )
+            client = get_shared_openai_client(
+                endpoint.api_base, endpoint.api_key, asynchronous=True
+            )
+            if self.rate_limiter is not None:
+                await asyncio.to_thread(self.rate_limiter.acquire)
+            start_time = time.time()
+            try:
+                async with get_endpoint_semaphore(endpoint.api_base, asynchronous=True):
+                    response = await client.chat.completions.create(**completion_kwargs)
+                endpoint.record(time.time() - start_time, success=True)
+                self.last_input_token_count = response.usage.prompt_tokens
+                self.last_output_token_count = response.usage.completion_tokens
+                self.last_call_duration = time.perf_counter() - call_start_time
+                return ChatMessage.from_dict(
+                    response.choices[0].message.model_dump(
+                        include={"role", "content", "tool_calls"}
+                    ),
+                    raw=response,
+                )
+            except Exception as e:
+                endpoint.record(time.time() - start_time, success=False, error=e)
+                if attempt < self.max_retries and self.can_fail_over(e):
+                    print(f"Got an endpoint error: {e}. Trying another endpoint...")
+                    continue
+                if attempt == self.max_retries or not is_retryable_error(e):
+                    raise Exception(
+                        f"All endpoints failed after {attempt + 1} attempts. Last error: {e}"
+                    )
+                delay = get_retry_delay(e, attempt)
+                print(
+                    f"Got an error: {e}. Sleeping for {delay:.1f} seconds and retrying..."
+                )
+                await asyncio.sleep(delay)
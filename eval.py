@@ -1,16 +1,24 @@
 import os
 import json
+import shutil
 import argparse
 import subprocess
 import threading
 import concurrent.futures
+import traceback
 from datetime import datetime
-from e2b_desktop import Sandbox
+from eval_index import read_run_metadata
 from local_desktop import LocalDesktop
+from sandbox_pool import SandboxPool, SandboxResetter, create_e2b_sandbox
+from trace_writer import StepTraceWriter
 from huggingface_hub import get_token
-from io import BytesIO
-from PIL import Image
-from e2bqwen import OpenRouterModel, E2BVisionAgent, get_agent_summary_erase_images
+from e2bqwen import (
+    OpenRouterModel,
+    E2BVisionAgent,
+    ImageEncodingPolicy,
+    RateLimiter,
+    ResponseCache,
+)
 
 from dotenv import load_dotenv
 
@@ -32,6 +40,15 @@ except ImportError:
 WIDTH = 1024
 HEIGHT = 768
 SANDBOX_TIMEOUT = 600  # 10 minutes
+MODEL_ID = os.getenv("OPENROUTER_MODEL_ID", "Qwen/Qwen2.5-VL-72B-Instruct:free")
+DEFAULT_NUM_RUNS = 3
+DEFAULT_MAX_STEPS = 200
+# Opt-in cache of model responses, shared by all agents, for tasks that are run again and again
+RESPONSE_CACHE = (
+    ResponseCache(os.getenv("RESPONSE_CACHE_PATH"))
+    if os.getenv("RESPONSE_CACHE_PATH")
+    else None
+)
 
 # Thread lock for print statements to avoid garbled output
 print_lock = threading.Lock()
@@ -59,10 +76,18 @@ def get_git_hash():
         return "nogit"
 
 
-def create_agent(data_dir, desktop, max_steps: int):
+def create_agent(data_dir, desktop, max_steps: int, rate_limiter=None):
     """Create an agent with the E2B desktop sandbox"""
     model = OpenRouterModel(
-        model_id=os.getenv("OPENROUTER_MODEL_ID", "Qwen/Qwen2.5-VL-72B-Instruct:free"),
+        model_id=MODEL_ID,
+        fallback_endpoints=[
+            model_id
+            for model_id in os.getenv("OPENROUTER_FALLBACK_MODEL_IDS", "").split(",")
+            if model_id
+        ],
+        hedge_requests=os.getenv("MODEL_HEDGE_REQUESTS", "").lower() in ["true", "1"],
+        response_cache=RESPONSE_CACHE,
+        rate_limiter=rate_limiter,
     )
     # model = OpenAIServerModel(
     #     model_id="gpt-4o",
@@ -74,52 +99,43 @@ def create_agent(data_dir, desktop, max_steps: int):
         desktop=desktop,
         max_steps=max_steps,
         verbosity_level=2,
+        image_encoding=ImageEncodingPolicy.from_env(),
+        enable_action_macros=os.getenv("ACTION_MACROS", "").lower() in ["true", "1"],
         # planning_interval=10,
     )
 
 
-def chat_message_to_json(obj):
-    """Custom JSON serializer for ChatMessage and related objects"""
-    if hasattr(obj, "__dict__"):
-        # Create a copy of the object's __dict__ to avoid modifying the original
-        result = obj.__dict__.copy()
-
-        # Remove the 'raw' field which may contain non-serializable data
-        if "raw" in result:
-            del result["raw"]
-
-        # Process the content or tool_calls if they exist
-        if "content" in result and result["content"] is not None:
-            if hasattr(result["content"], "__dict__"):
-                result["content"] = chat_message_to_json(result["content"])
-
-        if "tool_calls" in result and result["tool_calls"] is not None:
-            result["tool_calls"] = [
-                chat_message_to_json(tc) for tc in result["tool_calls"]
-            ]
-
-        return result
-    elif isinstance(obj, (list, tuple)):
-        return [chat_message_to_json(item) for item in obj]
-    else:
-        return obj
-
-
-def save_final_status(folder, status: str, summary, error_message=None) -> None:
-    """Save metadata about the run"""
+def save_final_status(folder, status: str, error_message=None) -> None:
+    """Save how the run ended. Its steps are already in steps.jsonl, written as they happened."""
     metadata_path = os.path.join(folder, "metadata.json")
-    with open(metadata_path, "w") as output_file:
+    # Written to a temporary file first, so that an interrupted write is not read as a finished run
+    with open(metadata_path + ".tmp", "w") as output_file:
         output_file.write(
             json.dumps(
-                {"status": status, "summary": summary, "error_message": error_message},
-                default=chat_message_to_json,
+                {
+                    "status": status,
+                    "error_message": error_message,
+                    "trace": "steps.jsonl",
+                }
             )
         )
-
-
-def run_example_once(example_name, example_text, run_index, example_dir, max_steps):
+    os.replace(metadata_path + ".tmp", metadata_path)
+
+
+def run_example_once(
+    example_name,
+    example_text,
+    run_index,
+    example_dir,
+    max_steps,
+    rate_limiter=None,
+    sandbox_pool=None,
+):
     """Run a single example once and return the result"""
     run_dir = os.path.join(example_dir, f"run_{run_index}")
+    # A run re-queued by a resumed evaluation starts over from an empty folder
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
     os.makedirs(run_dir, exist_ok=True)
 
     # Save the example text
@@ -130,6 +146,8 @@ def run_example_once(example_name, example_text, run_index, example_dir, max_ste
 
     # Create a new sandbox for this run
     desktop = None
+    agent = None
+    trace_writer = None
     try:
         # Check if we should use local desktop
         USE_LOCAL_DESKTOP = os.getenv("USE_LOCAL_DESKTOP", "false").lower() == "true"
@@ -144,28 +162,30 @@ def run_example_once(example_name, example_text, run_index, example_dir, max_ste
             desktop.stream.start(require_auth=True)
         else:
             thread_safe_print(f"  Using E2B desktop for run {run_index}")
-            desktop = Sandbox(
-                api_key=E2B_API_KEY,
-                resolution=(WIDTH, HEIGHT),
-                dpi=96,
-                timeout=SANDBOX_TIMEOUT,
-                template="k0wmnzir0zuzye6dndlw",
-            )
-            desktop.stream.start(require_auth=True)
-
-            # Initialize the desktop environment (only needed for E2B desktop)
-            setup_cmd = """sudo mkdir -p /usr/lib/firefox-esr/distribution && echo '{"policies":{"OverrideFirstRunPage":"","OverridePostUpdatePage":"","DisableProfileImport":true,"DontCheckDefaultBrowser":true}}' | sudo tee /usr/lib/firefox-esr/distribution/policies.json > /dev/null"""
-            desktop.commands.run(setup_cmd)
+            if sandbox_pool:
+                desktop = sandbox_pool.checkout()
+            else:
+                desktop = create_e2b_sandbox(
+                    api_key=E2B_API_KEY,
+                    resolution=(WIDTH, HEIGHT),
+                    timeout=SANDBOX_TIMEOUT,
+                )
 
         # Create and run the agent
-        agent = create_agent(data_dir=run_dir, desktop=desktop, max_steps=max_steps)
+        agent = create_agent(
+            data_dir=run_dir,
+            desktop=desktop,
+            max_steps=max_steps,
+            rate_limiter=rate_limiter,
+        )
+        # Record each step as it happens, so that a crash loses at most one step
+        trace_writer = StepTraceWriter(os.path.join(run_dir, "steps.jsonl"))
+        agent.step_callbacks.append(trace_writer)
 
-        screenshot_bytes = desktop.screenshot(format="bytes")
-        initial_screenshot = Image.open(BytesIO(screenshot_bytes))
+        initial_screenshot = agent.grab_screen()
         try:
             agent.run(task=example_text, images=[initial_screenshot])
-            summary = get_agent_summary_erase_images(agent)
-            save_final_status(run_dir, "completed", summary=summary)
+            save_final_status(run_dir, "completed")
             thread_safe_print(
                 f"  ✓ Example '{example_name}' run {run_index} completed successfully"
             )
@@ -175,14 +195,7 @@ def run_example_once(example_name, example_text, run_index, example_dir, max_ste
             thread_safe_print(
                 f"  ✗ Example '{example_name}' run {run_index} failed: {error_message}"
             )
-            summary = (
-                get_agent_summary_erase_images(agent)
-                if hasattr(agent, "memory")
-                else None
-            )
-            save_final_status(
-                run_dir, "failed", summary=summary, error_message=error_message
-            )
+            save_final_status(run_dir, "failed", error_message=error_message)
             result = {"status": "failed", "run_dir": run_dir, "error": error_message}
     except Exception as e:
         raise e
@@ -190,11 +203,20 @@ def run_example_once(example_name, example_text, run_index, example_dir, max_ste
         thread_safe_print(
             f"  ✗ Example '{example_name}' run {run_index} failed: {error_message}"
         )
-        save_final_status(run_dir, "failed", summary=None, error_message=error_message)
+        save_final_status(run_dir, "failed", error_message=error_message)
         result = {"status": "failed", "run_dir": run_dir, "error": error_message}
     finally:
-        # Always clean up the sandbox
-        if desktop:
+        # Make sure all step screenshots are on disk and the writer thread is stopped
+        # before leaving the run. The sandbox is cleaned up below.
+        if agent:
+            agent.close(kill_desktop=False)
+            agent.export_timings(os.path.join(run_dir, "timings.csv"))
+        if trace_writer:
+            trace_writer.close()
+        # Always clean up the sandbox, or hand it back for the next run
+        if desktop and sandbox_pool and not isinstance(desktop, LocalDesktop):
+            sandbox_pool.checkin(desktop)
+        elif desktop:
             try:
                 desktop.kill()
             except:
@@ -202,107 +224,236 @@ def run_example_once(example_name, example_text, run_index, example_dir, max_ste
 
     return result
 
-import traceback
 
-def run_example(example_name, example_text, num_runs, example_dir, max_steps):
-    """Run a single example multiple times using threads for each run"""
-    thread_safe_print(f"\nRunning example '{example_name}': '{example_text[:50]}...'")
+def get_job_order(examples, num_runs):
+    """(example name, run index) jobs, round-robin over examples so that every example
+    progresses evenly and the last slots are not all taken by a single example's runs"""
+    return [
+        (example_name, run_index)
+        for run_index in range(num_runs)
+        for example_name in examples
+    ]
+
+
+def get_completed_runs(eval_dir, examples, num_runs):
+    """(example name, run index) of the runs of an evaluation directory that completed"""
+    return {
+        (example_name, run_index)
+        for example_name in examples
+        for run_index in range(num_runs)
+        if read_run_metadata(
+            os.path.join(eval_dir, f"example_{example_name}", f"run_{run_index}")
+        )[0]
+        == "completed"
+    }
 
-    results = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_runs) as executor:
-        # Submit all runs to the executor
-        future_to_run = {
-            executor.submit(
-                run_example_once, example_name, example_text, j, example_dir, max_steps
-            ): j
-            for j in range(num_runs)
-        }
 
-        # Collect results as they complete
-        for future in concurrent.futures.as_completed(future_to_run):
-            run_index = future_to_run[future]
-            try:
-                result = future.result()
-                results.append(result)
-            except Exception as exc:
-                error_traceback = traceback.format_exc()
-                thread_safe_print(
-                    f"  ✗ Run {run_index} for '{example_name}' generated an exception:\n{error_traceback}"
-                )
-                results.append(
-                    {"status": "error", "run_index": run_index, "error": str(exc)}
-                )
-
-    return results
+def load_run_config(eval_dir, num_runs, max_steps):
+    """Settings of the evaluation being resumed. Runs must all use the same settings,
+    so settings given again must match those saved when the evaluation started."""
+    config_path = os.path.join(eval_dir, "config.json")
+    if not os.path.exists(config_path):
+        if num_runs is None or max_steps is None:
+            raise ValueError(
+                f"{eval_dir} has no config.json: pass the --num-runs and --max-steps it was started with"
+            )
+        # Evaluations started before settings were saved: keep those given from now on
+        config = {"num_runs": num_runs, "max_steps": max_steps, "model_id": MODEL_ID}
+        with open(config_path, "w") as f:
+            json.dump(config, f, indent=2)
+        return config
+    with open(config_path, "r") as f:
+        config = json.load(f)
+    given = {"num_runs": num_runs, "max_steps": max_steps, "model_id": MODEL_ID}
+    conflicts = [
+        f"{name} is {value} but the evaluation used {config[name]}"
+        for name, value in given.items()
+        if value is not None and value != config.get(name)
+    ]
+    if conflicts:
+        raise ValueError(f"Cannot resume {eval_dir}: " + "; ".join(conflicts))
+    return config
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def create_reusable_sandbox_pool(max_parallel):
+    """Pool of E2B sandboxes that are reset and reused from one run to the next"""
+    resetter = SandboxResetter()
+
+    def create_sandbox():
+        desktop = create_e2b_sandbox(
+            api_key=E2B_API_KEY, resolution=(WIDTH, HEIGHT), timeout=SANDBOX_TIMEOUT
+        )
+        resetter.remember(desktop)
+        return desktop
+
+    # No background boots: sandboxes are only created by runs, so there are never more than max_parallel
+    return SandboxPool(
+        create_sandbox=create_sandbox,
+        target_size=0,
+        max_size=max_parallel,
+        ttl=SANDBOX_TIMEOUT - 60,
+        session_timeout=SANDBOX_TIMEOUT,
+        reset_sandbox=resetter.reset,
+    )
 
 
-def run_evaluation(examples, num_runs, output_dir, max_parallel, max_steps):
-    """Run each example n times and save the results"""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+def run_evaluation(
+    examples,
+    num_runs,
+    output_dir,
+    max_parallel,
+    max_steps,
+    max_model_rps=None,
+    reuse_sandboxes=False,
+    resume_dir=None,
+):
+    """Run each example n times and save the results.
+    At most max_parallel runs, hence sandboxes, are active at once, and all their model calls
+    together make at most max_model_rps requests per second.
+    With reuse_sandboxes, sandboxes are reset and reused between runs instead of killed.
+    With resume_dir, the runs of that evaluation that completed are kept and the others are run again.
+    num_runs and max_steps then default to the values the evaluation started with.
+    """
     git_hash = get_git_hash()
-    eval_dir = os.path.join(output_dir, f"eval_{timestamp}_{git_hash}")
-    os.makedirs(eval_dir, exist_ok=True)
+    if resume_dir:
+        eval_dir = resume_dir
+        examples_path = os.path.join(eval_dir, "examples.json")
+        if not os.path.exists(examples_path):
+            raise ValueError(f"{eval_dir} is not an evaluation directory")
+        config = load_run_config(eval_dir, num_runs, max_steps)
+        num_runs, max_steps = config["num_runs"], config["max_steps"]
+        # The examples of the interrupted evaluation, so that all its runs share the same tasks
+        with open(examples_path, "r") as f:
+            examples = json.load(f)
+        if not eval_dir.rstrip(os.sep).endswith(git_hash):
+            thread_safe_print(
+                f"Warning: resuming {eval_dir} with code at commit {git_hash}"
+            )
+    else:
+        num_runs = DEFAULT_NUM_RUNS if num_runs is None else num_runs
+        max_steps = DEFAULT_MAX_STEPS if max_steps is None else max_steps
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        eval_dir = os.path.join(output_dir, f"eval_{timestamp}_{git_hash}")
+        os.makedirs(eval_dir, exist_ok=True)
+
+        # Save examples and settings to the evaluation directory, to resume it with the same ones
+        with open(os.path.join(eval_dir, "examples.json"), "w") as f:
+            json.dump(examples, f, indent=2)
+        with open(os.path.join(eval_dir, "config.json"), "w") as f:
+            json.dump(
+                {"num_runs": num_runs, "max_steps": max_steps, "model_id": MODEL_ID},
+                f,
+                indent=2,
+            )
 
     start_time = datetime.now()
 
     thread_safe_print(f"Starting evaluation. Results will be saved to: {eval_dir}")
     thread_safe_print(
-        f"Will run {len(examples)} examples, {num_runs} times each, with {max_parallel} parallel examples"
+        f"Will run {len(examples)} examples, {num_runs} times each, with at most {max_parallel} runs in parallel"
+        + (f" and {max_model_rps} model requests per second" if max_model_rps else "")
     )
 
-    # Save examples to the evaluation directory
-    with open(os.path.join(eval_dir, "examples.json"), "w") as f:
-        json.dump(examples, f, indent=2)
-
-    all_results = {}
+    # Prepare the example directories first
+    example_dirs = {}
+    for example_name in examples:
+        example_dir = os.path.join(eval_dir, f"example_{example_name}")
+        os.makedirs(example_dir, exist_ok=True)
+        example_dirs[example_name] = example_dir
+
+    rate_limiter = (
+        RateLimiter(max_model_rps, burst=max(1, int(max_model_rps)))
+        if max_model_rps
+        else None
+    )
+    sandbox_pool = (
+        create_reusable_sandbox_pool(max_parallel) if reuse_sandboxes else None
+    )
+    all_results = {example_name: [] for example_name in examples}
+    completed_runs = (
+        get_completed_runs(eval_dir, examples, num_runs) if resume_dir else set()
+    )
+    for example_name, run_index in sorted(completed_runs):
+        all_results[example_name].append(
+            {"status": "completed", "run_index": run_index, "resumed": True}
+        )
+    jobs = [
+        job for job in get_job_order(examples, num_runs) if job not in completed_runs
+    ]
+    if resume_dir:
+        thread_safe_print(
+            f"Resuming: {len(completed_runs)} runs already completed, {len(jobs)} runs to go"
+        )
+    completed_jobs = 0
 
-    # Run examples in parallel, but limit the number of parallel examples
+    # A single flat pool of runs: its size caps the number of live sandboxes
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_parallel) as executor:
-        # Prepare the example directories first
-        example_dirs = {}
-        for example_name in examples:
-            example_dir = os.path.join(eval_dir, f"example_{example_name}")
-            os.makedirs(example_dir, exist_ok=True)
-            example_dirs[example_name] = example_dir
-
-        # Submit all examples to the executor
-        future_to_example = {
+        future_to_job = {
             executor.submit(
-                run_example,
+                run_example_once,
                 example_name,
-                example_text,
-                num_runs,
+                examples[example_name],
+                run_index,
                 example_dirs[example_name],
                 max_steps,
-            ): example_name
-            for example_name, example_text in examples.items()
+                rate_limiter,
+                sandbox_pool,
+            ): (example_name, run_index)
+            for example_name, run_index in jobs
         }
 
         # Collect results as they complete
-        for future in concurrent.futures.as_completed(future_to_example):
-            example_name = future_to_example[future]
+        for future in concurrent.futures.as_completed(future_to_job):
+            example_name, run_index = future_to_job[future]
             try:
-                results = future.result()
-                all_results[example_name] = results
+                result = future.result()
+            except Exception as exc:
+                error_traceback = traceback.format_exc()
+                thread_safe_print(
+                    f"  ✗ Run {run_index} for '{example_name}' generated an exception:\n{error_traceback}"
+                )
+                result = {"status": "error", "run_index": run_index, "error": str(exc)}
+            all_results[example_name].append(result)
+            completed_jobs += 1
 
+            # Throughput so far gives the remaining time, as all slots stay busy
+            elapsed = (datetime.now() - start_time).total_seconds()
+            remaining = elapsed / completed_jobs * (len(jobs) - completed_jobs)
+            thread_safe_print(
+                f"Progress: {completed_jobs}/{len(jobs)} runs done, elapsed {format_duration(elapsed)}, ETA {format_duration(remaining)}"
+            )
+            if len(all_results[example_name]) == num_runs:
                 # Calculate success rate for this example
-                success_count = sum(1 for r in results if r["status"] == "completed")
-                thread_safe_print(
-                    f"Example '{example_name}' complete: {success_count}/{num_runs} successful runs ({success_count / num_runs * 100:.1f}%)"
+                success_count = sum(
+                    1 for r in all_results[example_name] if r["status"] == "completed"
                 )
-            except Exception as exc:
                 thread_safe_print(
-                    f"Example '{example_name}' generated an exception: {exc}"
+                    f"Example '{example_name}' complete: {success_count}/{num_runs} successful runs ({success_count / num_runs * 100:.1f}%)"
                 )
-                all_results[example_name] = [{"status": "error", "error": str(exc)}]
 
-    # Calculate overall results and success rates
+    if sandbox_pool:
+        thread_safe_print(f"Sandbox pool: {sandbox_pool.get_metrics()}")
+        sandbox_pool.stop()
+
+    # Calculate overall results and success rates from the run folders, which also hold
+    # the runs of previous attempts of a resumed evaluation
+    completed_runs = get_completed_runs(eval_dir, examples, num_runs)
     success_counts = {
-        example_name: sum(1 for r in results if r["status"] == "completed")
-        for example_name, results in all_results.items()
+        example_name: sum(
+            1
+            for run_index in range(num_runs)
+            if (example_name, run_index) in completed_runs
+        )
+        for example_name in examples
     }
 
-    total_runs = sum(len(results) for results in all_results.values())
+    total_runs = len(examples) * num_runs
     total_successes = sum(success_counts.values())
 
     # Save summary to evaluation directory
@@ -311,10 +462,15 @@ def run_evaluation(examples, num_runs, output_dir, max_parallel, max_steps):
         "total_successes": total_successes,
         "success_rate": total_successes / total_runs if total_runs > 0 else 0,
         "example_success_rates": {
-            example_name: success_counts[example_name] / len(all_results[example_name])
+            example_name: success_counts[example_name] / num_runs
             for example_name in examples
         },
     }
+    if RESPONSE_CACHE:
+        summary["response_cache"] = {
+            **RESPONSE_CACHE.stats,
+            "hit_rate": RESPONSE_CACHE.hit_rate(),
+        }
 
     with open(os.path.join(eval_dir, "summary.json"), "w") as f:
         json.dump(summary, f, indent=2)
@@ -327,6 +483,10 @@ def run_evaluation(examples, num_runs, output_dir, max_parallel, max_steps):
         success_rate = summary["example_success_rates"][example_name] * 100
         thread_safe_print(f"Example '{example_name}': {success_rate:.1f}% success")
 
+    if RESPONSE_CACHE:
+        thread_safe_print(
+            f"Response cache hit rate: {RESPONSE_CACHE.hit_rate() * 100:.1f}%"
+        )
     print("Total duration:", datetime.now() - start_time)
 
     return eval_dir
@@ -335,7 +495,10 @@ def run_evaluation(examples, num_runs, output_dir, max_parallel, max_steps):
 def main():
     parser = argparse.ArgumentParser(description="Evaluate computer agent on examples")
     parser.add_argument(
-        "--num-runs", type=int, default=3, help="Number of runs per example"
+        "--num-runs",
+        type=int,
+        default=None,
+        help=f"Number of runs per example (default {DEFAULT_NUM_RUNS}, or that of the resumed evaluation)",
     )
     parser.add_argument(
         "--output-dir",
@@ -346,11 +509,32 @@ def main():
     parser.add_argument(
         "--max-parallel",
         type=int,
-        default=2,
-        help="Maximum number of examples to run in parallel",
+        default=4,
+        help="Maximum number of runs in parallel, which is also the maximum number of live sandboxes",
+    )
+    parser.add_argument(
+        "--max-model-rps",
+        type=float,
+        default=float(os.getenv("MODEL_MAX_RPS", 0)),
+        help="Maximum number of model requests per second across all runs (0 for no limit)",
+    )
+    parser.add_argument(
+        "--reuse-sandboxes",
+        action="store_true",
+        help="Reset E2B sandboxes after each run and reuse them, instead of booting one per run",
     )
     parser.add_argument(
-        "--max-steps", type=int, default=200, help="Maximum number of steps in each run"
+        "--resume",
+        type=str,
+        default=None,
+        metavar="EVAL_DIR",
+        help="Evaluation directory of an interrupted evaluation, whose completed runs are kept and others run again",
+    )
+    parser.add_argument(
+        "--max-steps",
+        type=int,
+        default=None,
+        help=f"Maximum number of steps in each run (default {DEFAULT_MAX_STEPS}, or that of the resumed evaluation)",
     )
     args = parser.parse_args()
 
@@ -368,7 +552,14 @@ def main():
 
     # Run the evaluation
     run_evaluation(
-        examples, args.num_runs, args.output_dir, args.max_parallel, args.max_steps
+        examples,
+        args.num_runs,
+        args.output_dir,
+        args.max_parallel,
+        args.max_steps,
+        max_model_rps=args.max_model_rps,
+        reuse_sandboxes=args.reuse_sandboxes,
+        resume_dir=args.resume,
     )
 
 
@@ -0,0 +1,543 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+# Bumped when the schema or the indexed values change, to rebuild older indexes
+SCHEMA_VERSION = 2
+# A run without metadata.json whose files did not change for this long was interrupted
+STALE_RUN_SECONDS = float(os.getenv("STALE_RUN_SECONDS", 600))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS evals (
+    eval_id TEXT PRIMARY KEY,
+    mtime REAL,
+    examples TEXT
+);
+CREATE TABLE IF NOT EXISTS examples (
+    eval_id TEXT,
+    example_id TEXT,
+    mtime REAL,
+    PRIMARY KEY (eval_id, example_id)
+);
+CREATE TABLE IF NOT EXISTS runs (
+    eval_id TEXT,
+    example_id TEXT,
+    run_id TEXT,
+    status TEXT,
+    step_count INTEGER,
+    duration REAL,
+    task TEXT,
+    screenshots TEXT,
+    mtime REAL,
+    metadata_mtime REAL,
+    steps_mtime REAL,
+    PRIMARY KEY (eval_id, example_id, run_id)
+);
+"""
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def get_unfinished_status(last_change):
+    """Status of a run without metadata.json, from the time its files last changed"""
+    if last_change is not None and time.time() - last_change < STALE_RUN_SECONDS:
+        return "running"
+    return "interrupted"
+
+
+def get_last_change(run_dir):
+    mtimes = [
+        get_mtime(path) for path in (run_dir, os.path.join(run_dir, "steps.jsonl"))
+    ]
+    mtimes = [mtime for mtime in mtimes if mtime is not None]
+    return max(mtimes) if mtimes else None
+
+
+def is_action_step(record):
+    """Whether a steps.jsonl record is an action step, which step counts are made of"""
+    return isinstance(record, dict) and record.get("type") == "ActionStep"
+
+
+def read_trace_stats(run_dir):
+    """Number of action steps and duration of a run, from the step records of its steps.jsonl.
+    Both are None without a trace."""
+    try:
+        with open(os.path.join(run_dir, "steps.jsonl"), "r") as f:
+            lines = f.readlines()
+    except OSError:
+        return None, None
+    step_count = 0
+    start_times = []
+    end_times = []
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            # The last line of a running or killed run may be incomplete
+            continue
+        if not is_action_step(record):
+            continue
+        step_count += 1
+        if record.get("start_time"):
+            start_times.append(record["start_time"])
+        if record.get("end_time"):
+            end_times.append(record["end_time"])
+    duration = max(end_times) - min(start_times) if start_times and end_times else None
+    return step_count, duration
+
+
+def read_run_metadata(run_dir):
+    """Status, step count and duration of a run, from its metadata.json and steps.jsonl"""
+    try:
+        with open(os.path.join(run_dir, "metadata.json"), "r") as f:
+            metadata = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        metadata = None
+    step_count, duration = read_trace_stats(run_dir)
+    if metadata is None:
+        return get_unfinished_status(get_last_change(run_dir)), step_count, duration
+    if step_count is None:
+        # Runs saved without a trace: their summary holds one tool call message per action step
+        step_count = sum(
+            1
+            for message in metadata.get("summary") or []
+            if isinstance(message, dict) and message.get("role") == "tool-call"
+        )
+    return metadata.get("status", "unknown"), step_count, duration
+
+
+def read_task(run_dir):
+    try:
+        with open(os.path.join(run_dir, "task.txt"), "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+# Step indexes are kept with the eval index: written in the run directories, they would change
+# their modification time and make the eval index read them again
+STEP_INDEX_DIR = ".steps_index"
+JSON_DECODER = json.JSONDecoder()
+WHITESPACE = " \t\n\r"
+
+
+def skip_whitespace(text, position):
+    while position < len(text) and text[position] in WHITESPACE:
+        position += 1
+    return position
+
+
+def scan_metadata(text):
+    """Character spans of the steps in a metadata.json text, and its other top-level fields.
+    Each value is decoded by the C JSON scanner, without building the whole document at once.
+    """
+    fields = {}
+    spans = []
+    position = skip_whitespace(text, 0)
+    if text[position : position + 1] != "{":
+        raise ValueError("metadata.json should contain a JSON object")
+    position = skip_whitespace(text, position + 1)
+    while text[position] != "}":
+        key, position = JSON_DECODER.raw_decode(text, position)
+        position = skip_whitespace(text, position)
+        if text[position] != ":":
+            raise ValueError(f"Expected ':' at character {position}")
+        position = skip_whitespace(text, position + 1)
+        if key == "summary" and text[position] == "[":
+            position = skip_whitespace(text, position + 1)
+            while text[position] != "]":
+                _, end = JSON_DECODER.raw_decode(text, position)
+                spans.append((position, end))
+                position = skip_whitespace(text, end)
+                if text[position] == ",":
+                    position = skip_whitespace(text, position + 1)
+            position += 1
+        else:
+            fields[key], position = JSON_DECODER.raw_decode(text, position)
+        position = skip_whitespace(text, position)
+        if text[position] == ",":
+            position = skip_whitespace(text, position + 1)
+    return spans, fields
+
+
+def build_step_index(run_dir):
+    """Byte offsets of each step of a run, to read steps without loading the whole trace.
+    Steps come from steps.jsonl, or from the summary in metadata.json for runs saved before
+    steps were recorded as they happened.
+    """
+    metadata_path = os.path.join(run_dir, "metadata.json")
+    spans, fields = [], {}
+    if os.path.exists(metadata_path):
+        with open(metadata_path, "rb") as f:
+            data = f.read()
+        text = data.decode("utf-8")
+        spans, fields = scan_metadata(text)
+    if spans:
+        if len(text) == len(data):
+            offsets = [list(span) for span in spans]
+        else:
+            # Non-ASCII content: convert character positions to byte positions
+            offsets = []
+            byte_position = 0
+            character_position = 0
+            for start, end in spans:
+                byte_position += len(text[character_position:start].encode("utf-8"))
+                byte_end = byte_position + len(text[start:end].encode("utf-8"))
+                offsets.append([byte_position, byte_end])
+                byte_position, character_position = byte_end, end
+        source = "metadata.json"
+    else:
+        source = "steps.jsonl"
+        fields.pop("summary", None)
+        offsets = []
+        byte_position = 0
+        try:
+            with open(os.path.join(run_dir, source), "rb") as f:
+                for line in f:
+                    # A line without its newline may still be being written
+                    if line.endswith(b"\n") and line.strip():
+                        offsets.append([byte_position, byte_position + len(line)])
+                    byte_position += len(line)
+        except OSError:
+            pass
+    return {"source": source, "fields": fields, "offsets": offsets}
+
+
+def get_step_index(run_dir, index_dir=None):
+    """Step index of a run, rebuilt only when its source file changed since it was saved
+    in index_dir. Without index_dir, it is rebuilt every time."""
+    sources = {
+        name: get_mtime(os.path.join(run_dir, name))
+        for name in ("metadata.json", "steps.jsonl")
+    }
+    if index_dir is None:
+        return build_step_index(run_dir)
+    run_key = hashlib.sha1(os.path.abspath(run_dir).encode()).hexdigest()
+    index_path = os.path.join(index_dir, f"{run_key}.json")
+    try:
+        with open(index_path, "r") as f:
+            step_index = json.load(f)
+        if step_index.get("mtimes") == sources:
+            return step_index
+    except (OSError, json.JSONDecodeError):
+        pass
+    step_index = build_step_index(run_dir)
+    step_index["mtimes"] = sources
+    try:
+        os.makedirs(index_dir, exist_ok=True)
+        temp_path = f"{index_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(step_index, f)
+        os.replace(temp_path, index_path)
+    except OSError:
+        # Read-only index directory: the index is just not cached
+        pass
+    return step_index
+
+
+def read_steps(run_dir, offset=0, limit=20, index_dir=None):
+    """Steps offset to offset + limit of a run, with the run's other metadata fields"""
+    step_index = get_step_index(run_dir, index_dir)
+    offsets = step_index["offsets"][offset : offset + limit]
+    steps = []
+    if offsets:
+        with open(os.path.join(run_dir, step_index["source"]), "rb") as f:
+            for start, end in offsets:
+                f.seek(start)
+                steps.append(json.loads(f.read(end - start)))
+    fields = step_index["fields"]
+    if "status" not in fields:
+        # Depends on the current time, so never cached
+        fields = {"status": get_unfinished_status(get_last_change(run_dir))}
+    return {
+        **fields,
+        "total": len(step_index["offsets"]),
+        "offset": offset,
+        "steps": steps,
+    }
+
+
+class EvalIndex:
+    """SQLite index of the evals, examples and runs under an eval results directory.
+
+    Directories are only re-read when their modification time changed, and a run's metadata.json
+    is only parsed again when it changed, so refreshing a large results directory stays cheap.
+    Refreshes of the same eval are at most one every min_refresh_interval seconds.
+    """
+
+    def __init__(self, base_dir, db_path=None, min_refresh_interval=2.0):
+        self.base_dir = base_dir
+        self.db_path = db_path or os.path.join(base_dir, ".eval_index.sqlite")
+        self.steps_index_dir = os.path.join(
+            os.path.dirname(os.path.abspath(self.db_path)), STEP_INDEX_DIR
+        )
+        self.min_refresh_interval = min_refresh_interval
+        self.last_refresh = {}
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            with self.connection:
+                for table in ("evals", "examples", "runs"):
+                    self.connection.execute(f"DROP TABLE IF EXISTS {table}")
+            self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.connection.executescript(SCHEMA)
+
+    def should_refresh(self, key):
+        now = time.time()
+        if now - self.last_refresh.get(key, 0) < self.min_refresh_interval:
+            return False
+        self.last_refresh[key] = now
+        return True
+
+    def refresh_evals(self):
+        """Add and remove evals to match the results directory"""
+        with self.lock:
+            if not self.should_refresh(None):
+                return
+            eval_ids = {
+                item
+                for item in os.listdir(self.base_dir)
+                if item.startswith("eval_")
+                and os.path.isdir(os.path.join(self.base_dir, item))
+            }
+            indexed = {
+                row["eval_id"]
+                for row in self.connection.execute("SELECT eval_id FROM evals")
+            }
+            with self.connection:
+                for eval_id in indexed - eval_ids:
+                    self.delete_eval(eval_id)
+                self.connection.executemany(
+                    "INSERT INTO evals (eval_id) VALUES (?)",
+                    [(eval_id,) for eval_id in eval_ids - indexed],
+                )
+
+    def delete_eval(self, eval_id):
+        for table in ("evals", "examples", "runs"):
+            self.connection.execute(
+                f"DELETE FROM {table} WHERE eval_id = ?", (eval_id,)
+            )
+
+    def delete_example(self, eval_id, example_id):
+        for table in ("examples", "runs"):
+            self.connection.execute(
+                f"DELETE FROM {table} WHERE eval_id = ? AND example_id = ?",
+                (eval_id, example_id),
+            )
+
+    def refresh_eval(self, eval_id):
+        """Re-read the examples and runs of an eval whose directories changed"""
+        eval_dir = os.path.join(self.base_dir, eval_id)
+        with self.lock:
+            if not self.should_refresh(eval_id):
+                return
+            eval_mtime = get_mtime(eval_dir)
+            if eval_mtime is None:
+                with self.connection:
+                    self.delete_eval(eval_id)
+                return
+            row = self.connection.execute(
+                "SELECT mtime FROM evals WHERE eval_id = ?", (eval_id,)
+            ).fetchone()
+            with self.connection:
+                if row is None or row["mtime"] != eval_mtime:
+                    self.index_eval(eval_id, eval_dir, eval_mtime)
+                for example in self.connection.execute(
+                    "SELECT example_id, mtime FROM examples WHERE eval_id = ?",
+                    (eval_id,),
+                ).fetchall():
+                    self.refresh_example(
+                        eval_id, example["example_id"], example["mtime"]
+                    )
+
+    def index_eval(self, eval_id, eval_dir, eval_mtime):
+        examples = None
+        try:
+            with open(os.path.join(eval_dir, "examples.json"), "r") as f:
+                examples = f.read()
+        except OSError:
+            pass
+        self.connection.execute(
+            "INSERT OR REPLACE INTO evals (eval_id, mtime, examples) VALUES (?, ?, ?)",
+            (eval_id, eval_mtime, examples),
+        )
+        example_ids = {
+            item[len("example_") :]
+            for item in os.listdir(eval_dir)
+            if item.startswith("example_")
+            and os.path.isdir(os.path.join(eval_dir, item))
+        }
+        indexed = {
+            row["example_id"]
+            for row in self.connection.execute(
+                "SELECT example_id FROM examples WHERE eval_id = ?", (eval_id,)
+            )
+        }
+        for example_id in indexed - example_ids:
+            self.delete_example(eval_id, example_id)
+        self.connection.executemany(
+            "INSERT INTO examples (eval_id, example_id) VALUES (?, ?)",
+            [(eval_id, example_id) for example_id in example_ids - indexed],
+        )
+
+    def refresh_example(self, eval_id, example_id, indexed_mtime):
+        example_dir = os.path.join(self.base_dir, eval_id, f"example_{example_id}")
+        example_mtime = get_mtime(example_dir)
+        if example_mtime is None:
+            self.delete_example(eval_id, example_id)
+            return
+        indexed_runs = {
+            row["run_id"]: row
+            for row in self.connection.execute(
+                "SELECT run_id, mtime, metadata_mtime, steps_mtime FROM runs WHERE eval_id = ? AND example_id = ?",
+                (eval_id, example_id),
+            )
+        }
+        if example_mtime != indexed_mtime:
+            run_ids = {
+                item
+                for item in os.listdir(example_dir)
+                if item.startswith("run_")
+                and os.path.isdir(os.path.join(example_dir, item))
+            }
+            for run_id in set(indexed_runs) - run_ids:
+                self.connection.execute(
+                    "DELETE FROM runs WHERE eval_id = ? AND example_id = ? AND run_id = ?",
+                    (eval_id, example_id, run_id),
+                )
+            self.connection.execute(
+                "UPDATE examples SET mtime = ? WHERE eval_id = ? AND example_id = ?",
+                (example_mtime, eval_id, example_id),
+            )
+        else:
+            run_ids = set(indexed_runs)
+
+        for run_id in run_ids:
+            run_dir = os.path.join(example_dir, run_id)
+            run_mtime = get_mtime(run_dir)
+            if run_mtime is None:
+                continue
+            metadata_mtime = get_mtime(os.path.join(run_dir, "metadata.json"))
+            # Appending steps does not change the run directory's mtime
+            steps_mtime = get_mtime(os.path.join(run_dir, "steps.jsonl"))
+            indexed_run = indexed_runs.get(run_id)
+            if (
+                indexed_run is not None
+                and indexed_run["mtime"] == run_mtime
+                and indexed_run["metadata_mtime"] == metadata_mtime
+                and indexed_run["steps_mtime"] == steps_mtime
+            ):
+                continue
+            self.index_run(
+                eval_id,
+                example_id,
+                run_id,
+                run_dir,
+                (run_mtime, metadata_mtime, steps_mtime),
+            )
+
+    def index_run(self, eval_id, example_id, run_id, run_dir, mtimes):
+        status, step_count, duration = read_run_metadata(run_dir)
+        screenshots = sorted(
+            item
+            for item in os.listdir(run_dir)
+            if item.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        self.connection.execute(
+            """INSERT OR REPLACE INTO runs
+            (eval_id, example_id, run_id, status, step_count, duration, task, screenshots, mtime, metadata_mtime, steps_mtime)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (
+                eval_id,
+                example_id,
+                run_id,
+                status,
+                step_count,
+                duration,
+                read_task(run_dir),
+                json.dumps(screenshots),
+                *mtimes,
+            ),
+        )
+
+    def list_evals(self):
+        self.refresh_evals()
+        with self.lock:
+            return [
+                row["eval_id"]
+                for row in self.connection.execute(
+                    "SELECT eval_id FROM evals ORDER BY eval_id"
+                )
+            ]
+
+    def get_examples(self, eval_id):
+        """Examples of an eval with their task, from examples.json or else from their runs"""
+        self.refresh_eval(eval_id)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT examples FROM evals WHERE eval_id = ?", (eval_id,)
+            ).fetchone()
+            if row is not None and row["examples"]:
+                try:
+                    examples = json.loads(row["examples"])
+                    if examples:
+                        return examples
+                except json.JSONDecodeError:
+                    pass
+            examples = {}
+            for example in self.connection.execute(
+                """SELECT examples.example_id, MIN(runs.task) AS task FROM examples
+                LEFT JOIN runs USING (eval_id, example_id)
+                WHERE examples.eval_id = ? GROUP BY examples.example_id""",
+                (eval_id,),
+            ):
+                examples[example["example_id"]] = (
+                    example["task"] or f"Task for {example['example_id']}"
+                )
+            return examples
+
+    def get_runs(self, eval_id, example_id):
+        self.refresh_eval(eval_id)
+        with self.lock:
+            rows = self.connection.execute(
+                """SELECT run_id, status, step_count, duration, mtime, metadata_mtime, steps_mtime
+                FROM runs WHERE eval_id = ? AND example_id = ? ORDER BY run_id""",
+                (eval_id, example_id),
+            ).fetchall()
+        runs = []
+        for row in rows:
+            status = row["status"]
+            if row["metadata_mtime"] is None:
+                # Running until its files stop changing for too long: decided when asked
+                last_change = max(row["mtime"] or 0, row["steps_mtime"] or 0)
+                status = get_unfinished_status(last_change or None)
+            runs.append(
+                {
+                    "id": row["run_id"],
+                    "status": status,
+                    "step_count": row["step_count"],
+                    "duration": row["duration"],
+                }
+            )
+        return runs
+
+    def get_screenshots(self, eval_id, example_id, run_id):
+        """File names of a run's screenshots, or None if the run is unknown"""
+        self.refresh_eval(eval_id)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT screenshots FROM runs WHERE eval_id = ? AND example_id = ? AND run_id = ?",
+                (eval_id, example_id, run_id),
+            ).fetchone()
+        return json.loads(row["screenshots"]) if row is not None else None
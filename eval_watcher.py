@@ -0,0 +1,222 @@
+import json
+import os
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from eval_index import get_mtime, is_action_step, read_run_metadata
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+if INotify is not None:
+    WATCH_FLAGS = flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO
+
+
+class EvalWatcher:
+    """Watches the runs of an evaluation directory and publishes their progress to subscribers.
+
+    Events are ("run", new run), ("step", new step in a run's steps.jsonl) and ("status", run
+    finished with a metadata.json). The watching thread only runs while someone is subscribed,
+    and is woken by inotify when inotify_simple is installed, else polls the run files.
+
+    Parameters:
+        eval_dir: The evaluation directory, holding example_*/run_* directories.
+        poll_interval: Seconds between two scans without inotify.
+    """
+
+    def __init__(self, eval_dir: str, poll_interval: float = 1.0):
+        self.eval_dir = eval_dir
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.subscribers: List[queue.Queue] = []
+        self.thread = None
+        # Per run: bytes of steps.jsonl already read, action steps seen and metadata mtime
+        self.runs: Dict[Tuple[str, str], dict] = {}
+        self.scan(publish=False)
+
+    def subscribe(self) -> queue.Queue:
+        events = queue.Queue(maxsize=1000)
+        with self.lock:
+            self.subscribers.append(events)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        return events
+
+    def unsubscribe(self, events: queue.Queue) -> None:
+        with self.lock:
+            if events in self.subscribers:
+                self.subscribers.remove(events)
+
+    def publish(self, event: str, data: dict) -> None:
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for events in subscribers:
+            try:
+                events.put_nowait((event, data))
+            except queue.Full:
+                # A client that stopped reading misses events rather than growing memory
+                pass
+
+    def has_subscribers(self) -> bool:
+        with self.lock:
+            if not self.subscribers:
+                self.thread = None
+                return False
+            return True
+
+    def _run(self):
+        inotify = None
+        if INotify is not None:
+            try:
+                inotify = INotify()
+            except OSError as e:
+                print(f"inotify unavailable, polling {self.eval_dir}: {str(e)}")
+        try:
+            if inotify is None:
+                while self.has_subscribers():
+                    self.scan()
+                    time.sleep(self.poll_interval)
+            else:
+                self._run_inotify(inotify)
+        except Exception as e:
+            print(f"Error watching {self.eval_dir}: {str(e)}")
+            with self.lock:
+                self.thread = None
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    def _run_inotify(self, inotify):
+        watched = {}
+
+        def watch(path):
+            if path not in watched.values():
+                watched[inotify.add_watch(path, WATCH_FLAGS)] = path
+
+        watch(self.eval_dir)
+        for example_dir, _ in self.list_example_dirs():
+            watch(example_dir)
+            for run_dir, _ in self.list_run_dirs(example_dir):
+                watch(run_dir)
+        # Catch up with what happened while nobody was subscribed
+        self.scan()
+
+        while self.has_subscribers():
+            changed = set()
+            for event in inotify.read(timeout=1000):
+                path = watched.get(event.wd)
+                if path is None:
+                    continue
+                if event.mask & flags.ISDIR and event.name:
+                    watch(os.path.join(path, event.name))
+                changed.add(path)
+            if self.eval_dir in changed:
+                self.scan()
+                continue
+            for path in changed:
+                parent, name = os.path.split(path)
+                if name.startswith("example_"):
+                    self.scan_example(path, name[len("example_") :])
+                elif name.startswith("run_"):
+                    example_id = os.path.basename(parent)[len("example_") :]
+                    self.check_run(path, example_id, name)
+
+    def list_example_dirs(self):
+        try:
+            entries = list(os.scandir(self.eval_dir))
+        except OSError:
+            return []
+        return sorted(
+            (entry.path, entry.name[len("example_") :])
+            for entry in entries
+            if entry.is_dir() and entry.name.startswith("example_")
+        )
+
+    def list_run_dirs(self, example_dir):
+        try:
+            entries = list(os.scandir(example_dir))
+        except OSError:
+            return []
+        return sorted(
+            (entry.path, entry.name)
+            for entry in entries
+            if entry.is_dir() and entry.name.startswith("run_")
+        )
+
+    def scan(self, publish: bool = True) -> None:
+        for example_dir, example_id in self.list_example_dirs():
+            self.scan_example(example_dir, example_id, publish)
+
+    def scan_example(self, example_dir, example_id, publish: bool = True) -> None:
+        for run_dir, run_id in self.list_run_dirs(example_dir):
+            self.check_run(run_dir, example_id, run_id, publish)
+
+    def check_run(
+        self, run_dir: str, example_id: str, run_id: str, publish: bool = True
+    ) -> None:
+        key = (example_id, run_id)
+        run = self.runs.get(key)
+        if run is None:
+            run = self.runs[key] = {"offset": 0, "steps": 0, "metadata_mtime": None}
+            if publish:
+                self.publish("run", {"example_id": example_id, "run_id": run_id})
+
+        new_steps = self.read_new_steps(run_dir, run)
+        if new_steps and publish:
+            self.publish(
+                "step",
+                {
+                    "example_id": example_id,
+                    "run_id": run_id,
+                    "step_count": run["steps"],
+                },
+            )
+
+        metadata_mtime = get_mtime(os.path.join(run_dir, "metadata.json"))
+        if metadata_mtime != run["metadata_mtime"]:
+            run["metadata_mtime"] = metadata_mtime
+            if metadata_mtime is not None and publish:
+                status, step_count, duration = read_run_metadata(run_dir)
+                self.publish(
+                    "status",
+                    {
+                        "example_id": example_id,
+                        "run_id": run_id,
+                        "status": status,
+                        "step_count": step_count,
+                        "duration": duration,
+                    },
+                )
+
+    def read_new_steps(self, run_dir: str, run: dict) -> int:
+        """Count the action steps appended to steps.jsonl since the last read"""
+        try:
+            with open(os.path.join(run_dir, "steps.jsonl"), "rb") as f:
+                f.seek(run["offset"])
+                data = f.read()
+        except OSError:
+            return 0
+        # Leave a line that is still being written for the next read
+        data = data[: data.rfind(b"\n") + 1]
+        run["offset"] += len(data)
+        new_steps = 0
+        for line in data.splitlines():
+            try:
+                if is_action_step(json.loads(line)):
+                    new_steps += 1
+            except json.JSONDecodeError:
+                continue
+        run["steps"] += new_steps
+        return new_steps
+
+
+def format_event(event: str, data: Optional[dict] = None) -> str:
+    """A Server-Sent Event, or a comment keeping the connection open without data"""
+    if data is None:
+        return f": {event}\n\n"
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
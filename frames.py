@@ -0,0 +1,54 @@
+from typing import List
+
+from PIL import Image, ImageChops, ImageStat
+
+# Size of the downscaled grayscale frames compared during settle detection
+SETTLE_FRAME_SIZE = (64, 48)
+
+
+def downscale_frame(image, size=SETTLE_FRAME_SIZE):
+    """Reduce a screenshot to a small grayscale frame that is cheap to compare"""
+    return image.convert("L").resize(size, Image.BILINEAR)
+
+
+def frame_difference(frame_a, frame_b) -> float:
+    """Mean absolute pixel difference between two downscaled frames, from 0 to 255"""
+    return ImageStat.Stat(ImageChops.difference(frame_a, frame_b)).mean[0]
+
+
+def images_identical(image_a, image_b) -> bool:
+    """Whether two screenshots have exactly the same pixels"""
+    if image_a is None or image_b is None or image_a.size != image_b.size:
+        return False
+    if image_a.mode != image_b.mode:
+        image_a, image_b = image_a.convert("RGB"), image_b.convert("RGB")
+    return ImageChops.difference(image_a, image_b).getbbox() is None
+
+
+def compute_frame_hash(image, tiles=(8, 6)) -> List[int]:
+    """Tiled average hash of a screenshot: one 64-bit hash per tile of a tiles[0] x tiles[1] grid"""
+    frame = downscale_frame(image, (tiles[0] * 8, tiles[1] * 8))
+    tile_hashes = []
+    for row in range(tiles[1]):
+        for column in range(tiles[0]):
+            pixels = list(
+                frame.crop(
+                    (column * 8, row * 8, (column + 1) * 8, (row + 1) * 8)
+                ).getdata()
+            )
+            mean = sum(pixels) / len(pixels)
+            tile_hash = 0
+            for pixel in pixels:
+                tile_hash = (tile_hash << 1) | (pixel > mean)
+            tile_hashes.append(tile_hash)
+    return tile_hashes
+
+
+def frames_match(hash_a, hash_b, max_bit_distance: int = 2) -> bool:
+    """Whether every tile of two frame hashes differs by at most max_bit_distance bits"""
+    if hash_a is None or hash_b is None or len(hash_a) != len(hash_b):
+        return False
+    return all(
+        bin(tile_a ^ tile_b).count("1") <= max_bit_distance
+        for tile_a, tile_b in zip(hash_a, hash_b)
+    )
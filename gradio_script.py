@@ -7,6 +7,8 @@ from smolagents.memory import ActionStep, FinalAnswerStep, MemoryStep
 from smolagents.models import ChatMessageStreamDelta
 from smolagents.utils import _is_package_available
 
+from metrics import MODEL_TOKENS
+
 
 def pull_messages_from_step(step_log: MemoryStep, skip_model_outputs: bool = False):
     """Extract ChatMessage objects from agent steps with proper nesting.
@@ -223,6 +225,8 @@ def stream_to_gradio(
             if isinstance(step_log, (ActionStep, PlanningStep)):
                 step_log.input_token_count = agent.model.last_input_token_count
                 step_log.output_token_count = agent.model.last_output_token_count
+                MODEL_TOKENS.inc(step_log.input_token_count, direction="input")
+                MODEL_TOKENS.inc(step_log.output_token_count or 0, direction="output")
 
         if isinstance(step_log, MemoryStep):
             intermediate_text = ""
@@ -0,0 +1,112 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from PIL import Image, features
+
+# Output formats of resized images, with their Pillow encoder options
+IMAGE_FORMATS = {
+    "webp": ("WEBP", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", {"quality": 85, "optimize": True}),
+    "png": ("PNG", {"optimize": True}),
+}
+MIMETYPES = {"webp": "image/webp", "jpeg": "image/jpeg", "png": "image/png"}
+MAX_WIDTH = 4096
+
+
+def get_image_key(path, width=None, fmt=None):
+    """Key of an image variant, changing whenever the source file is rewritten"""
+    stat = os.stat(path)
+    source = f"{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}"
+    return hashlib.sha256(f"{source}:{width or 0}:{fmt or ''}".encode()).hexdigest()
+
+
+class ImageVariantCache:
+    """Resized and re-encoded copies of images, kept on disk and evicted least recently used first.
+
+    Parameters:
+        cache_dir: Directory holding the derived images.
+        max_bytes: Total size of the derived images above which the oldest are deleted.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir or os.path.join(
+            tempfile.gettempdir(), "eval_viewer_images"
+        )
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Files left by a previous process, oldest use first
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+            elif os.path.isfile(path):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name, stat.st_size))
+        self.entries = OrderedDict((name, size) for _, name, size in sorted(entries))
+        self.total_bytes = sum(self.entries.values())
+
+    def get_format(self, fmt):
+        """Output format for a requested one, falling back to JPEG without WebP support"""
+        fmt = (fmt or "webp").lower().replace("jpg", "jpeg")
+        if fmt not in IMAGE_FORMATS:
+            raise ValueError(f"Format should be one of {tuple(IMAGE_FORMATS)}")
+        if fmt == "webp" and not features.check("webp"):
+            return "jpeg"
+        return fmt
+
+    def get(self, source_path, width=None, fmt=None):
+        """Path, key and format of a variant of source_path, created on first request"""
+        fmt = self.get_format(fmt)
+        if width is not None:
+            width = min(max(int(width), 16), MAX_WIDTH)
+        key = get_image_key(source_path, width, fmt)
+        name = f"{key}.{fmt}"
+        path = os.path.join(self.cache_dir, name)
+
+        with self.lock:
+            if name in self.entries and os.path.exists(path):
+                self.entries.move_to_end(name)
+                self.stats["hits"] += 1
+                # The modification time orders the files for the next process
+                os.utime(path)
+                return path, key, fmt
+
+        # Concurrent requests for the same variant each render it, the last replace wins
+        self.render(source_path, path, width, fmt)
+        size = os.path.getsize(path)
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(name, 0)
+            self.entries[name] = size
+            self.stats["misses"] += 1
+            self.evict()
+        return path, key, fmt
+
+    def render(self, source_path, path, width, fmt):
+        pil_format, options = IMAGE_FORMATS[fmt]
+        with Image.open(source_path) as image:
+            if width is not None and image.width > width:
+                height = max(1, round(image.height * width / image.width))
+                image = image.resize((width, height), Image.LANCZOS)
+            if fmt == "jpeg" and image.mode != "RGB":
+                image = image.convert("RGB")
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            image.save(temp_path, pil_format, **options)
+        os.replace(temp_path, path)
+
+    def evict(self):
+        """Delete least recently used variants until the cache fits. Called with the lock held."""
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.stats["evictions"] += 1
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
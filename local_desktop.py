@@ -1,47 +1,82 @@
 import os
 import time
+import secrets
 import subprocess
 import platform
 import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
-from PIL import Image, ImageGrab
+from urllib.parse import parse_qs, quote, urlparse
+from PIL import Image, ImageChops, ImageGrab
 import pyautogui
 
+try:
+    # Optional: grabs frames through shared memory (XShm on Linux), much faster than ImageGrab
+    import mss
+except ImportError:
+    mss = None
+
+# Seconds after which an unchanged screen is sent again to stream viewers
+STREAM_KEEPALIVE_INTERVAL = 2.0
+STREAM_PAGE = """<!DOCTYPE html>
+<html>
+<body style="margin:0;background:#000;">
+<img src="/stream.mjpg?auth_key=<<AUTH_KEY>>" style="width:100%;height:100%;object-fit:contain;">
+</body>
+</html>
+"""
+
 class LocalDesktopStream:
     """
     A class to simulate the streaming functionality of E2B desktop
     but using the local desktop instead.
+    Serves a live MJPEG stream of the desktop from a small local HTTP server.
     """
-    def __init__(self):
+    def __init__(self, grab_frame=None, fps=None, quality=None, host=None, port=None):
         self.is_running = False
         self.auth_key = "local"
-        self.screenshot_path = os.path.join(os.getcwd(), "local_desktop_screenshot.png")
-        self.update_screenshot()
-    
-    def update_screenshot(self):
-        """Take a screenshot and save it to the screenshot path"""
-        try:
-            screenshot = ImageGrab.grab()
-            screenshot.save(self.screenshot_path)
-            return True
-        except Exception as e:
-            print(f"Error taking screenshot: {e}")
-            return False
+        self.require_auth = False
+        self.grab_frame = grab_frame or ImageGrab.grab
+        self.fps = fps or float(os.getenv("LOCAL_STREAM_FPS", 5))
+        self.quality = quality or int(os.getenv("LOCAL_STREAM_QUALITY", 70))
+        self.host = host or os.getenv("LOCAL_STREAM_HOST", "127.0.0.1")
+        self.port = port if port is not None else int(os.getenv("LOCAL_STREAM_PORT", 0))
+        self.server = None
+        # Latest encoded frame, shared by all viewers: each one always gets the newest frame,
+        # so a slow viewer skips frames instead of queueing them
+        self.frame_condition = threading.Condition()
+        self.frame_jpeg = None
+        self.frame_id = 0
+        self.viewers = 0
+        self.capture_thread = None
     
     def start(self, require_auth=False):
         """Start the local desktop stream"""
+        if self.is_running:
+            return True
+        self.require_auth = require_auth
+        if require_auth:
+            self.auth_key = secrets.token_urlsafe(16)
+        self.server = ThreadingHTTPServer((self.host, self.port), self.make_handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
         self.is_running = True
-        self.update_screenshot()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.capture_thread = threading.Thread(target=self.capture_frames, daemon=True)
+        self.capture_thread.start()
+        print(f"Local desktop stream at http://{self.host}:{self.port}/")
         return True
     
     def stop(self):
         """Stop the local desktop stream"""
+        if not self.is_running:
+            return True
         self.is_running = False
-        if os.path.exists(self.screenshot_path):
-            try:
-                os.remove(self.screenshot_path)
-            except:
-                pass
+        with self.frame_condition:
+            self.frame_condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
         return True
     
     def get_auth_key(self):
@@ -49,9 +84,110 @@ class LocalDesktopStream:
         return self.auth_key
     
     def get_url(self, auth_key=None):
-        """Get the URL for the stream - in this case, we'll use a local file path"""
-        self.update_screenshot()
-        return f"file:///{self.screenshot_path.replace(os.sep, '/')}"
+        """Get the URL of the page showing the live stream"""
+        return f"http://{self.host}:{self.port}/?auth_key={auth_key or self.auth_key}"
+    
+    def capture_frames(self):
+        """Grab and encode frames at the configured FPS while someone is watching.
+        Frames identical to the previous one are not re-encoded nor re-sent."""
+        previous_frame = None
+        last_sent = 0.0
+        while self.is_running:
+            with self.frame_condition:
+                if self.viewers == 0:
+                    # The screen may have changed while nobody was watching
+                    previous_frame = None
+                while self.is_running and self.viewers == 0:
+                    self.frame_condition.wait()
+            start_time = time.time()
+            try:
+                frame = self.grab_frame().convert("RGB")
+                # Damaged region since the previous frame, None if nothing changed
+                damage = (
+                    ImageChops.difference(previous_frame, frame).getbbox()
+                    if previous_frame is not None and previous_frame.size == frame.size
+                    else (0, 0, *frame.size)
+                )
+                # Still send a frame now and then, so that new viewers get a picture
+                if damage is not None or start_time - last_sent > STREAM_KEEPALIVE_INTERVAL:
+                    output = BytesIO()
+                    frame.save(output, format="JPEG", quality=self.quality)
+                    with self.frame_condition:
+                        self.frame_jpeg = output.getvalue()
+                        self.frame_id += 1
+                        self.frame_condition.notify_all()
+                    last_sent = start_time
+                previous_frame = frame
+            except Exception as e:
+                print(f"Error capturing stream frame: {e}")
+            time.sleep(max(1 / self.fps - (time.time() - start_time), 0))
+    
+    def wait_for_frame(self, last_frame_id, timeout=5.0):
+        """Block until a frame newer than last_frame_id is available, and return it with its id"""
+        with self.frame_condition:
+            self.frame_condition.wait_for(
+                lambda: not self.is_running or self.frame_id > last_frame_id, timeout
+            )
+            return self.frame_id, self.frame_jpeg
+    
+    def make_handler(self):
+        stream = self
+        
+        class StreamHandler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+            
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if stream.require_auth and query.get("auth_key", [None])[0] != stream.auth_key:
+                    self.send_error(403)
+                    return
+                if url.path == "/":
+                    self.send_page(query.get("auth_key", [""])[0])
+                elif url.path == "/stream.mjpg":
+                    self.send_stream()
+                else:
+                    self.send_error(404)
+            
+            def send_page(self, auth_key):
+                body = STREAM_PAGE.replace("<<AUTH_KEY>>", quote(auth_key)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def send_stream(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                with stream.frame_condition:
+                    stream.viewers += 1
+                    stream.frame_condition.notify_all()
+                frame_id = 0
+                try:
+                    while stream.is_running:
+                        new_frame_id, frame_jpeg = stream.wait_for_frame(frame_id)
+                        if new_frame_id == frame_id or frame_jpeg is None:
+                            continue
+                        frame_id = new_frame_id
+                        # Blocks while the viewer is slow, which holds back this viewer only
+                        self.wfile.write(
+                            b"--frame\r\nContent-Type: image/jpeg\r\n"
+                            + f"Content-Length: {len(frame_jpeg)}\r\n\r\n".encode()
+                            + frame_jpeg
+                            + b"\r\n"
+                        )
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    with stream.frame_condition:
+                        stream.viewers -= 1
+        
+        return StreamHandler
 
 
 class LocalDesktop:
@@ -64,23 +200,45 @@ class LocalDesktop:
         self.resolution = resolution
         self.dpi = dpi
         self.timeout = timeout
-        self.stream = LocalDesktopStream()
         self.last_screenshot = None
+        # mss grabbers can only be used from the thread that created them
+        self.grabbers = threading.local()
+        self.stream = LocalDesktopStream(grab_frame=self.grab_frame)
+    
+    # Formats accepted by screenshot(): "pil" and "raw" skip the PNG encoding
+    screenshot_formats = ("bytes", "pil", "raw")
     
     def get_screen_size(self):
         """Get the screen size of the local desktop"""
         return self.resolution
     
-    def screenshot(self, format="bytes"):
-        """Take a screenshot of the local desktop"""
-        # Capture the entire screen
-        screenshot = ImageGrab.grab()
+    def grab_frame(self):
+        """Capture the entire screen as an RGB PIL image at the configured resolution"""
+        if mss is not None:
+            if not hasattr(self.grabbers, "mss"):
+                self.grabbers.mss = mss.mss()
+            shot = self.grabbers.mss.grab(self.grabbers.mss.monitors[1])
+            # Decoded straight from the BGRA frame buffer
+            screenshot = Image.frombuffer("RGB", shot.size, shot.bgra, "raw", "BGRX")
+        else:
+            screenshot = ImageGrab.grab()
         
         # Resize to match the configured resolution if needed
         if screenshot.size != self.resolution:
             screenshot = screenshot.resize(self.resolution)
+        return screenshot
+    
+    def screenshot(self, format="bytes"):
+        """Take a screenshot of the local desktop.
+        format is "bytes" for PNG bytes, "pil" for a PIL image, "raw" for RGB pixel bytes,
+        or anything else for the path of a temporary PNG file."""
+        screenshot = self.grab_frame()
         
-        if format == "bytes":
+        if format == "pil":
+            return screenshot
+        elif format == "raw":
+            return screenshot.convert("RGB").tobytes()
+        elif format == "bytes":
             # Convert to bytes
             img_byte_arr = BytesIO()
             screenshot.save(img_byte_arr, format='PNG')
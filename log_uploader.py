@@ -0,0 +1,179 @@
+import json
+import os
+import random
+import shutil
+import threading
+import time
+from typing import Dict, List, Optional
+
+from huggingface_hub import upload_folder
+
+
+class LogUploader:
+    """Uploads interaction log folders to a Hub dataset from a background thread.
+
+    Enqueued folders are moved into a staging directory and recorded in an on-disk manifest,
+    so that pending uploads survive restarts. The worker uploads up to batch_size staged folders
+    in a single commit, and retries failed commits with exponential backoff.
+
+    Parameters:
+        repo_id: Dataset repository receiving the logs.
+        staging_dir: Directory where folders wait for their upload.
+        skip_tasks: Folders whose task is one of these are deleted instead of uploaded.
+        batch_size: Maximum number of folders per commit.
+        batch_interval: Seconds to wait for more folders before committing a batch.
+        max_backoff: Maximum delay between two failed attempts, in seconds.
+    """
+
+    def __init__(
+        self,
+        repo_id: str,
+        staging_dir: str,
+        skip_tasks: Optional[List[str]] = None,
+        batch_size: int = 50,
+        batch_interval: float = 30.0,
+        max_backoff: float = 600.0,
+    ):
+        self.repo_id = repo_id
+        self.staging_dir = staging_dir
+        self.manifest_path = os.path.join(staging_dir, "manifest.json")
+        self.skip_tasks = set(skip_tasks or [])
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.wake_up = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.stats: Dict[str, int] = {
+            "queued": 0,
+            "skipped": 0,
+            "uploaded": 0,
+            "commits": 0,
+            "failed_commits": 0,
+        }
+        os.makedirs(staging_dir, exist_ok=True)
+        self.pending = self._load_manifest()
+
+    def _load_manifest(self) -> List[str]:
+        """Folders left over by a previous run: those in the manifest, plus any staged folder
+        the manifest missed because of a crash right after moving it"""
+        pending = []
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, "r") as f:
+                    pending = json.load(f)
+            except json.JSONDecodeError:
+                print(f"Ignoring corrupted upload manifest {self.manifest_path}")
+        staged = sorted(
+            name
+            for name in os.listdir(self.staging_dir)
+            if os.path.isdir(os.path.join(self.staging_dir, name))
+        )
+        pending = [name for name in pending if name in staged]
+        pending += [name for name in staged if name not in pending]
+        if pending:
+            print(f"Resuming upload of {len(pending)} staged log folders")
+        return pending
+
+    def _save_manifest(self) -> None:
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.pending, f)
+        os.replace(temp_path, self.manifest_path)
+
+    def _should_skip(self, folder_path: str) -> bool:
+        """Folders without a task, or whose task is an example, are not uploaded"""
+        metadata_path = os.path.join(folder_path, "metadata.jsonl")
+        if not os.path.exists(metadata_path):
+            return True
+        try:
+            with open(metadata_path, "r") as f:
+                task = json.loads(f.readline())["task"]
+        except (json.JSONDecodeError, KeyError):
+            return True
+        return task in self.skip_tasks
+
+    def enqueue(self, folder_paths: List[str]) -> None:
+        """Stage folders for upload. This only moves them on the local disk."""
+        for folder_path in folder_paths:
+            if not os.path.isdir(folder_path):
+                continue
+            if self._should_skip(folder_path):
+                shutil.rmtree(folder_path, ignore_errors=True)
+                self.stats["skipped"] += 1
+                print(f"Folder {folder_path} removed without upload.")
+                continue
+            folder_name = os.path.basename(os.path.normpath(folder_path))
+            if os.path.exists(os.path.join(self.staging_dir, folder_name)):
+                folder_name = f"{folder_name}_{int(time.time() * 1000)}"
+            shutil.move(folder_path, os.path.join(self.staging_dir, folder_name))
+            with self.lock:
+                self.pending.append(folder_name)
+                self._save_manifest()
+                self.stats["queued"] += 1
+                batch_ready = len(self.pending) >= self.batch_size
+            if batch_ready:
+                self.wake_up.set()
+
+    def queue_size(self) -> int:
+        with self.lock:
+            return len(self.pending)
+
+    def start(self) -> None:
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self) -> None:
+        """Stop the worker after its current commit. Staged folders stay in the manifest."""
+        self.stopped.set()
+        self.wake_up.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        failed_attempts = 0
+        delay = self.batch_interval
+        while not self.stopped.is_set():
+            self.wake_up.wait(delay)
+            self.wake_up.clear()
+            with self.lock:
+                batch = self.pending[: self.batch_size]
+            if not batch or self.stopped.is_set():
+                delay = self.batch_interval
+                continue
+
+            try:
+                print(f"Uploading {len(batch)} folders to {self.repo_id}...")
+                upload_folder(
+                    folder_path=self.staging_dir,
+                    repo_id=self.repo_id,
+                    repo_type="dataset",
+                    allow_patterns=[f"{folder_name}/*" for folder_name in batch],
+                    ignore_patterns=[".git/*", ".gitignore"],
+                    commit_message=f"Upload {len(batch)} interaction logs",
+                )
+            except Exception as e:
+                failed_attempts += 1
+                self.stats["failed_commits"] += 1
+                delay = min(
+                    self.max_backoff, self.batch_interval * 2**failed_attempts
+                ) * random.uniform(0.5, 1.0)
+                print(f"Error uploading logs, retrying in {delay:.0f}s: {str(e)}")
+                continue
+
+            for folder_name in batch:
+                shutil.rmtree(
+                    os.path.join(self.staging_dir, folder_name), ignore_errors=True
+                )
+            with self.lock:
+                self.pending = [name for name in self.pending if name not in batch]
+                self._save_manifest()
+                self.stats["uploaded"] += len(batch)
+                self.stats["commits"] += 1
+                more_pending = bool(self.pending)
+            print(f"Upload of {len(batch)} folders complete.")
+            failed_attempts = 0
+            # Drain a backlog right away, else wait for the next batch to fill
+            delay = 0 if more_pending else self.batch_interval
@@ -0,0 +1,205 @@
+import threading
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+# Upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def escape_label_value(value) -> str:
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return value.replace("\n", "\\n")
+
+
+def format_labels(labelnames: Tuple[str, ...], labelvalues: Tuple[str, ...], **extra):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra.items())
+    if not pairs:
+        return ""
+    labels = ",".join(f'{name}="{escape_label_value(value)}"' for name, value in pairs)
+    return "{" + labels + "}"
+
+
+class Metric:
+    """Base class of the metrics below, keeping one value per combination of label values"""
+
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values: Dict[Tuple[str, ...], object] = {}
+        REGISTRY.append(self)
+
+    def get_key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"Metric {self.name} expects labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.append(
+                f"{self.name}{format_labels(self.labelnames, key)} {float(value):g}"
+            )
+        return lines
+
+
+class Counter(Metric):
+    """Value that only goes up"""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that can go up and down"""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """Distribution of observed values, counted in cumulative buckets"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.get_key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {
+                    "buckets": [0] * len(self.buckets),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            series = self.values[key]
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with self.lock:
+            items = sorted(
+                (key, {**series, "buckets": list(series["buckets"])})
+                for key, series in self.values.items()
+            )
+        for key, series in items:
+            for upper_bound, count in zip(self.buckets, series["buckets"]):
+                labels = format_labels(self.labelnames, key, le=f"{upper_bound:g}")
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = format_labels(self.labelnames, key, le="+Inf")
+            lines.append(f"{self.name}_bucket{labels} {series['count']}")
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {series['sum']:g}")
+            lines.append(f"{self.name}_count{labels} {series['count']}")
+        return lines
+
+
+class Collector(Metric):
+    """Metric read at render time from a function, for state kept elsewhere.
+
+    collect returns a number, or a dict mapping tuples of label values to numbers.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        type: str,
+        collect: Callable[[], Union[float, Dict[Tuple[str, ...], float]]],
+        labelnames: Tuple[str, ...] = (),
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.type = type
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        try:
+            values = self.collect()
+        except Exception as e:
+            print(f"Error collecting metric {self.name}: {str(e)}")
+            return []
+        with self.lock:
+            self.values = values if isinstance(values, dict) else {(): values}
+        return super().render()
+
+
+REGISTRY: List[Metric] = []
+
+
+def render_metrics(metrics: Optional[List[Metric]] = None) -> str:
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY if metrics is None else metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Agent step latency, shared by every agent in the process
+STEP_PHASE_SECONDS = Histogram(
+    "agent_step_phase_seconds",
+    "Time spent in each phase of an agent step",
+    labelnames=("phase",),
+)
+TOOL_CALL_SECONDS = Histogram(
+    "agent_tool_call_seconds",
+    "Time spent executing agent tools",
+    labelnames=("tool",),
+)
+TOOL_CALLS = Counter(
+    "agent_tool_calls_total",
+    "Agent tool calls, by outcome",
+    labelnames=("tool", "status"),
+)
+AGENT_STEPS = Counter("agent_steps_total", "Agent steps completed")
+MODEL_CALL_SECONDS = Histogram(
+    "model_call_seconds",
+    "Latency of model API calls, by endpoint and outcome",
+    labelnames=("endpoint", "status"),
+)
+MODEL_TOKENS = Counter(
+    "model_tokens_total",
+    "Tokens consumed by the agents' model calls",
+    labelnames=("direction",),
+)
+SANDBOX_CREATE_SECONDS = Histogram(
+    "sandbox_create_seconds",
+    "Time to boot and set up a new sandbox",
+)
+SANDBOX_CHECKOUT_SECONDS = Histogram(
+    "sandbox_checkout_seconds",
+    "Time to get a sandbox for a session, by pool result",
+    labelnames=("result",),
+)
@@ -0,0 +1,285 @@
+import threading
+import time
+from collections import deque
+from io import BytesIO
+from typing import Any, Callable, Dict, Optional
+
+from e2b_desktop import Sandbox
+from PIL import Image
+
+from frames import compute_frame_hash
+from metrics import SANDBOX_CHECKOUT_SECONDS, SANDBOX_CREATE_SECONDS
+
+E2B_TEMPLATE = "k0wmnzir0zuzye6dndlw"
+FIREFOX_SETUP_CMD = """sudo mkdir -p /usr/lib/firefox-esr/distribution && echo '{"policies":{"OverrideFirstRunPage":"","OverridePostUpdatePage":"","DisableProfileImport":true,"DontCheckDefaultBrowser":true}}' | sudo tee /usr/lib/firefox-esr/distribution/policies.json > /dev/null"""
+
+
+# Closes the apps a task may have opened and forgets the browser profile and downloads.
+# pkill -x matches process names exactly, so it cannot kill the shell running this command.
+RESET_CMD = """for app in firefox-esr firefox soffice.bin gedit mousepad xfce4-terminal thunar; do pkill -x $app; done; sleep 1; rm -rf ~/.mozilla/firefox ~/.cache/mozilla ~/Downloads/*; true"""
+# Share of screen tiles that must match the fresh desktop after a reset, leaving room for the clock
+RESET_MIN_MATCHING_TILES = 0.9
+
+
+def create_e2b_sandbox(
+    api_key: Optional[str], resolution=(1024, 768), timeout: int = 300
+) -> Sandbox:
+    """Boot an E2B desktop, start its stream and set up Firefox"""
+    desktop = Sandbox(
+        api_key=api_key,
+        resolution=resolution,
+        dpi=96,
+        timeout=timeout,
+        template=E2B_TEMPLATE,
+    )
+    desktop.stream.start(require_auth=True)
+    desktop.commands.run(FIREFOX_SETUP_CMD)
+    return desktop
+
+
+class SandboxResetter:
+    """Brings a used E2B sandbox back to the state of a freshly booted one.
+
+    The first sandbox passed to remember() provides the reference screen: a reset succeeds
+    when the screen matches it again.
+    """
+
+    def __init__(self, timeout: float = 5.0):
+        self.timeout = timeout
+        self.reference_hash = None
+
+    def get_screen_hash(self, desktop):
+        return compute_frame_hash(
+            Image.open(BytesIO(desktop.screenshot(format="bytes")))
+        )
+
+    def remember(self, desktop) -> None:
+        """Record the screen of a freshly booted sandbox as the reference"""
+        if self.reference_hash is None:
+            self.reference_hash = self.get_screen_hash(desktop)
+
+    def screen_matches_reference(self, desktop) -> bool:
+        screen_hash = self.get_screen_hash(desktop)
+        matching_tiles = sum(
+            bin(tile_a ^ tile_b).count("1") <= 2
+            for tile_a, tile_b in zip(screen_hash, self.reference_hash)
+        )
+        return matching_tiles >= RESET_MIN_MATCHING_TILES * len(self.reference_hash)
+
+    def reset(self, desktop) -> bool:
+        """Close apps and clear the browser profile, then check the screen against the reference"""
+        if self.reference_hash is None:
+            return False
+        desktop.commands.run(RESET_CMD)
+        width, height = desktop.get_screen_size()
+        desktop.move_mouse(width // 2, height // 2)
+        desktop.press("esc")
+        deadline = time.time() + self.timeout
+        while True:
+            if self.screen_matches_reference(desktop):
+                return True
+            if time.time() >= deadline:
+                print(
+                    f"Sandbox {desktop.sandbox_id} does not look fresh after its reset"
+                )
+                return False
+            time.sleep(0.5)
+
+
+class SandboxPool:
+    """Keeps pre-booted sandboxes ready to be checked out instantly.
+
+    A background thread boots sandboxes until target_size of them are idle, never holding more
+    than max_size idle or booting sandboxes. Idle sandboxes older than ttl seconds are killed.
+    When the pool is empty, checkout boots a sandbox on the spot.
+
+    Parameters:
+        create_sandbox: Function booting and setting up a new sandbox.
+        target_size: Number of idle sandboxes to keep ready.
+        max_size: Maximum number of idle and booting sandboxes.
+        ttl: Seconds after which an idle sandbox is discarded.
+        session_timeout: Lifetime given to a sandbox when it is checked out, in seconds.
+        reset_sandbox: Function resetting a used sandbox, returning whether it succeeded.
+            Without it, sandboxes given back through checkin are killed.
+    """
+
+    def __init__(
+        self,
+        create_sandbox: Callable[[], Any],
+        target_size: int = 1,
+        max_size: int = 4,
+        ttl: float = 240,
+        session_timeout: Optional[int] = None,
+        replenish_interval: float = 5.0,
+        reset_sandbox: Optional[Callable[[Any], bool]] = None,
+    ):
+        self.create_sandbox = create_sandbox
+        self.target_size = target_size
+        self.max_size = max(max_size, target_size)
+        self.ttl = ttl
+        self.session_timeout = session_timeout
+        self.replenish_interval = replenish_interval
+        self.reset_sandbox = reset_sandbox
+        # Idle sandboxes with their creation time, oldest first
+        self.idle: deque = deque()
+        self.booting = 0
+        self.lock = threading.Lock()
+        self.wake_up = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.metrics: Dict[str, float] = {
+            "hits": 0,
+            "misses": 0,
+            "created": 0,
+            "create_failures": 0,
+            "expired": 0,
+            "checkouts": 0,
+            "checkout_latency_total": 0.0,
+            "checkout_latency_last": 0.0,
+            "resets": 0,
+            "reset_failures": 0,
+        }
+
+    def start(self) -> None:
+        """Start replenishing the pool in the background"""
+        if self.thread is None and self.target_size > 0:
+            self.thread = threading.Thread(target=self._maintain, daemon=True)
+            self.thread.start()
+
+    def stop(self) -> None:
+        """Stop replenishing and kill idle sandboxes"""
+        self.stopped.set()
+        self.wake_up.set()
+        with self.lock:
+            idle = [desktop for desktop, _ in self.idle]
+            self.idle.clear()
+        for desktop in idle:
+            self._kill(desktop)
+
+    def checkout(self):
+        """Take a ready sandbox from the pool, or boot one if none is available"""
+        start_time = time.time()
+        desktop = None
+        expired = []
+        with self.lock:
+            while self.idle:
+                candidate, created_at = self.idle.popleft()
+                if start_time - created_at < self.ttl:
+                    desktop = candidate
+                    break
+                expired.append(candidate)
+            self.metrics["expired"] += len(expired)
+        for candidate in expired:
+            self._kill(candidate)
+
+        pool_hit = desktop is not None
+        if pool_hit:
+            if self.session_timeout:
+                try:
+                    desktop.set_timeout(self.session_timeout)
+                except Exception as e:
+                    print(f"Could not extend the timeout of a pooled sandbox: {str(e)}")
+        else:
+            desktop = self._create()
+        # Replace the sandbox that was just taken
+        self.wake_up.set()
+
+        latency = time.time() - start_time
+        with self.lock:
+            self.metrics["hits" if pool_hit else "misses"] += 1
+            if not pool_hit:
+                self.metrics["created"] += 1
+            self.metrics["checkouts"] += 1
+            self.metrics["checkout_latency_total"] += latency
+            self.metrics["checkout_latency_last"] = latency
+        SANDBOX_CHECKOUT_SECONDS.observe(latency, result="hit" if pool_hit else "miss")
+        print(
+            f"Checked out sandbox {desktop.sandbox_id} in {latency:.2f}s (pool {'hit' if pool_hit else 'miss'})"
+        )
+        return desktop
+
+    def checkin(self, desktop) -> None:
+        """Give back a used sandbox: it is reset and kept for the next checkout,
+        or killed if it cannot be reset or if the pool is full"""
+        reusable = self.reset_sandbox is not None and not self.stopped.is_set()
+        if reusable:
+            try:
+                reusable = self.reset_sandbox(desktop)
+                if reusable and self.session_timeout:
+                    # Outlive its stay in the pool, whatever the length of the last session
+                    desktop.set_timeout(self.session_timeout)
+            except Exception as e:
+                print(f"Error resetting sandbox {desktop.sandbox_id}: {str(e)}")
+                reusable = False
+            with self.lock:
+                self.metrics["resets" if reusable else "reset_failures"] += 1
+        if reusable:
+            with self.lock:
+                reusable = len(self.idle) + self.booting < self.max_size
+                if reusable:
+                    self.idle.append((desktop, time.time()))
+        if reusable:
+            print(f"Sandbox {desktop.sandbox_id} is reset and back in the pool")
+        else:
+            self._kill(desktop)
+
+    def get_metrics(self) -> Dict[str, float]:
+        with self.lock:
+            return {**self.metrics, "idle": len(self.idle), "booting": self.booting}
+
+    def _maintain(self):
+        while not self.stopped.is_set():
+            expired = []
+            with self.lock:
+                now = time.time()
+                while self.idle and now - self.idle[0][1] >= self.ttl:
+                    expired.append(self.idle.popleft()[0])
+                self.metrics["expired"] += len(expired)
+                missing = max(
+                    min(self.target_size, self.max_size)
+                    - len(self.idle)
+                    - self.booting,
+                    0,
+                )
+                self.booting += missing
+            for desktop in expired:
+                self._kill(desktop)
+            for _ in range(missing):
+                threading.Thread(target=self._boot, daemon=True).start()
+
+            self.wake_up.wait(self.replenish_interval)
+            self.wake_up.clear()
+
+    def _create(self):
+        start_time = time.time()
+        desktop = self.create_sandbox()
+        SANDBOX_CREATE_SECONDS.observe(time.time() - start_time)
+        return desktop
+
+    def _boot(self):
+        try:
+            desktop = self._create()
+        except Exception as e:
+            print(f"Error booting a sandbox for the pool: {str(e)}")
+            with self.lock:
+                self.booting -= 1
+                self.metrics["create_failures"] += 1
+            return
+        with self.lock:
+            self.booting -= 1
+            self.metrics["created"] += 1
+            if self.stopped.is_set():
+                desktop_to_kill = desktop
+            else:
+                self.idle.append((desktop, time.time()))
+                desktop_to_kill = None
+        if desktop_to_kill is not None:
+            self._kill(desktop_to_kill)
+        else:
+            print(f"Sandbox {desktop.sandbox_id} is ready in the pool")
+
+    def _kill(self, desktop):
+        try:
+            desktop.kill()
+        except Exception as e:
+            print(f"Error killing pooled sandbox: {str(e)}")
@@ -1,13 +1,72 @@
 import os
 import json
-import glob
+import queue
+import threading
 import traceback
-from flask import Flask, render_template, jsonify, send_file, request
+from urllib.parse import quote
+from flask import (
+    Flask,
+    Response,
+    render_template,
+    jsonify,
+    send_file,
+    request,
+    stream_with_context,
+)
 from flask_cors import CORS
 
+from eval_index import EvalIndex, read_steps
+from eval_watcher import EvalWatcher, format_event
+from image_cache import MIMETYPES, ImageVariantCache, get_image_key
+
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
+# One index per results directory, kept in that directory
+EVAL_INDEXES = {}
+EVAL_INDEXES_LOCK = threading.Lock()
+
+
+def get_eval_index(base_dir):
+    base_dir = os.path.abspath(base_dir)
+    with EVAL_INDEXES_LOCK:
+        if base_dir not in EVAL_INDEXES:
+            EVAL_INDEXES[base_dir] = EvalIndex(base_dir)
+        return EVAL_INDEXES[base_dir]
+
+
+# One watcher per evaluation directory, shared by all the clients following it
+EVAL_WATCHERS = {}
+EVAL_WATCHERS_LOCK = threading.Lock()
+# Seconds between two comments keeping an idle event stream open
+EVENTS_KEEPALIVE_INTERVAL = 15
+
+
+def get_eval_watcher(eval_dir):
+    eval_dir = os.path.abspath(eval_dir)
+    with EVAL_WATCHERS_LOCK:
+        if eval_dir not in EVAL_WATCHERS:
+            EVAL_WATCHERS[eval_dir] = EvalWatcher(eval_dir)
+        return EVAL_WATCHERS[eval_dir]
+
+
+# Resized screenshots, shared by all results directories
+IMAGE_CACHE = ImageVariantCache(
+    os.getenv("IMAGE_CACHE_DIR"),
+    max_bytes=int(os.getenv("IMAGE_CACHE_MAX_MB", "512")) * 1024 * 1024,
+)
+# Screenshots are never rewritten, so versioned image URLs can be cached for good
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+THUMBNAIL_WIDTH = 256
+PREVIEW_WIDTH = 1280
+
+
+def get_image_url(path, **params):
+    """URL of an image, versioned by its modification time"""
+    query = "&".join(f"{name}={value}" for name, value in params.items())
+    url = f"/api/image?path={quote(path)}&v={os.stat(path).st_mtime_ns}"
+    return f"{url}&{query}" if query else url
+
 
 # Serve the HTML viewer
 @app.route("/")
@@ -22,13 +81,7 @@ def list_evals():
     if not os.path.exists(base_dir):
         return jsonify({"error": f"Path {base_dir} does not exist"}), 404
 
-    eval_dirs = []
-    for item in os.listdir(base_dir):
-        full_path = os.path.join(base_dir, item)
-        if os.path.isdir(full_path) and item.startswith("eval_"):
-            eval_dirs.append(item)
-
-    return jsonify(eval_dirs)
+    return jsonify(get_eval_index(base_dir).list_evals())
 
 
 # Get examples for an evaluation
@@ -36,64 +89,10 @@ def list_evals():
 def get_examples(eval_id):
     base_dir = request.args.get("path", "./eval_results")
     eval_path = os.path.join(base_dir, eval_id)
+    if not os.path.exists(eval_path):
+        return jsonify({"error": f"Eval directory not found: {eval_path}"}), 404
 
-    # Try to read examples.json
-    examples_json_path = os.path.join(eval_path, "examples.json")
-    examples = {}
-
-    if os.path.exists(examples_json_path):
-        try:
-            with open(examples_json_path, "r") as f:
-                examples = json.load(f)
-        except json.JSONDecodeError:
-            app.logger.error(f"Error parsing examples.json at {examples_json_path}")
-
-    # If examples.json doesn't exist or is empty, scan for example directories
-    if not examples:
-        for item in os.listdir(eval_path):
-            if os.path.isdir(os.path.join(eval_path, item)) and item.startswith(
-                "example_"
-            ):
-                example_id = item.replace("example_", "")
-                example_dir = os.path.join(eval_path, item)
-
-                # Find the first run and read task.txt
-                run_dirs = []
-                for run_item in os.listdir(example_dir):
-                    run_path = os.path.join(example_dir, run_item)
-                    if os.path.isdir(run_path) and run_item.startswith("run_"):
-                        run_dirs.append(run_item)
-
-                if run_dirs:
-                    task_path = os.path.join(example_dir, run_dirs[0], "task.txt")
-                    if os.path.exists(task_path):
-                        with open(task_path, "r") as f:
-                            examples[example_id] = f.read().strip()
-                    else:
-                        # If no task.txt, try reading from metadata.json
-                        metadata_path = os.path.join(
-                            example_dir, run_dirs[0], "metadata.json"
-                        )
-                        if os.path.exists(metadata_path):
-                            try:
-                                with open(metadata_path, "r") as f:
-                                    metadata = json.load(f)
-                                    # Look for task in summary[0].task
-                                    if (
-                                        "summary" in metadata
-                                        and metadata["summary"]
-                                        and "task" in metadata["summary"][0]
-                                    ):
-                                        examples[example_id] = metadata["summary"][0][
-                                            "task"
-                                        ]
-                            except:
-                                # Default to directory name if all else fails
-                                examples[example_id] = f"Task for {example_id}"
-                        else:
-                            examples[example_id] = f"Task for {example_id}"
-
-    return jsonify(examples)
+    return jsonify(get_eval_index(base_dir).get_examples(eval_id))
 
 
 # Get runs for an example
@@ -105,27 +104,7 @@ def get_runs(eval_id, example_id):
     if not os.path.exists(example_dir):
         return jsonify({"error": f"Example directory not found: {example_dir}"}), 404
 
-    runs = []
-    for item in os.listdir(example_dir):
-        item_path = os.path.join(example_dir, item)
-        if os.path.isdir(item_path) and item.startswith("run_"):
-            run_id = item
-
-            # Try to get status from metadata.json
-            metadata_path = os.path.join(item_path, "metadata.json")
-            status = "unknown"
-
-            if os.path.exists(metadata_path):
-                try:
-                    with open(metadata_path, "r") as f:
-                        metadata = json.load(f)
-                        status = metadata.get("status", "unknown")
-                except Exception as e:
-                    app.logger.error(
-                        f"Error reading metadata.json for {run_id}: {str(e)}"
-                    )
-
-            runs.append({"id": run_id, "status": status})
+    runs = get_eval_index(base_dir).get_runs(eval_id, example_id)
     app.logger.info(f"runs: {runs}")
 
     return jsonify(runs)
@@ -169,6 +148,59 @@ def get_metadata(eval_id, example_id, run_id):
         return jsonify(error_info), 500
 
 
+# Stream the progress of the runs of an evaluation as Server-Sent Events
+@app.route("/api/eval/<eval_id>/events")
+def get_events(eval_id):
+    base_dir = request.args.get("path", "./eval_results")
+    eval_dir = os.path.join(base_dir, eval_id)
+
+    if not os.path.exists(eval_dir):
+        return jsonify({"error": f"Evaluation directory not found: {eval_dir}"}), 404
+
+    watcher = get_eval_watcher(eval_dir)
+
+    def stream():
+        events = watcher.subscribe()
+        try:
+            yield format_event("connected")
+            while True:
+                try:
+                    event, data = events.get(timeout=EVENTS_KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    yield format_event("keepalive")
+                    continue
+                yield format_event(event, data)
+        finally:
+            # Runs when the client disconnects and the next write fails
+            watcher.unsubscribe(events)
+
+    return Response(
+        stream_with_context(stream()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# Get a page of the steps of a run, without loading its whole trace
+@app.route("/api/eval/<eval_id>/example/<example_id>/run/<run_id>/steps")
+def get_steps(eval_id, example_id, run_id):
+    base_dir = request.args.get("path", "./eval_results")
+    run_dir = os.path.join(base_dir, eval_id, f"example_{example_id}", run_id)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", 20, type=int), 0), 200)
+
+    if not os.path.exists(run_dir):
+        return jsonify({"error": f"Run directory not found: {run_dir}"}), 404
+
+    try:
+        index_dir = get_eval_index(base_dir).steps_index_dir
+        return jsonify(read_steps(run_dir, offset, limit, index_dir))
+    except (ValueError, IndexError) as e:
+        app.logger.error(f"Error indexing steps of {run_dir}: {str(e)}")
+        error_info = {"error": "Invalid JSON in metadata file", "details": str(e)}
+        return jsonify(error_info), 400
+
+
 # Get screenshots for a run
 @app.route("/api/eval/<eval_id>/example/<example_id>/run/<run_id>/screenshots")
 def get_screenshots(eval_id, example_id, run_id):
@@ -179,23 +211,27 @@ def get_screenshots(eval_id, example_id, run_id):
         return jsonify({"error": f"Run directory not found: {run_dir}"}), 404
 
     screenshots = []
-    for ext in ["png", "jpg", "jpeg"]:
-        pattern = os.path.join(run_dir, f"*.{ext}")
-        for file_path in glob.glob(pattern):
-            filename = os.path.basename(file_path)
-            screenshots.append(
-                {"name": filename, "path": f"/api/image?path={file_path}"}
-            )
-
-    # Sort by filename
-    screenshots.sort(key=lambda x: x["name"])
+    for filename in (
+        get_eval_index(base_dir).get_screenshots(eval_id, example_id, run_id) or []
+    ):
+        path = os.path.join(run_dir, filename)
+        if not os.path.exists(path):
+            continue
+        screenshots.append(
+            {
+                "name": filename,
+                "path": get_image_url(path),
+                "preview": get_image_url(path, w=PREVIEW_WIDTH, fmt="webp"),
+                "thumbnail": get_image_url(path, w=THUMBNAIL_WIDTH, fmt="webp"),
+            }
+        )
 
     app.logger.info(f"screenshots: {screenshots}")
 
     return jsonify(screenshots)
 
 
-# Serve an image file
+# Serve an image file, resized with ?w=<width> or re-encoded with ?fmt=webp|jpeg|png
 @app.route("/api/image")
 def get_image():
     path = request.args.get("path")
@@ -205,8 +241,31 @@ def get_image():
     if not os.path.exists(path):
         return jsonify({"error": f"Image not found at path: {path}"}), 404
 
+    width = request.args.get("w", type=int)
+    fmt = request.args.get("fmt")
+    # Without a version in the URL, browsers revalidate with the ETag on each use
+    max_age = IMMUTABLE_MAX_AGE if request.args.get("v") else 0
+
     try:
-        return send_file(path)
+        last_modified = os.path.getmtime(path)
+        if width is None and fmt is None:
+            file_path, mimetype = path, None
+            etag = get_image_key(path)
+        else:
+            file_path, etag, fmt = IMAGE_CACHE.get(path, width, fmt)
+            mimetype = MIMETYPES[fmt]
+        response = send_file(
+            file_path,
+            mimetype=mimetype,
+            etag=etag,
+            last_modified=last_modified,
+            max_age=max_age,
+        )
+        if max_age:
+            response.cache_control.immutable = True
+        return response
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": f"Error serving image: {str(e)}"}), 500
 
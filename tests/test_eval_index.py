@@ -0,0 +1,175 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eval_index import EvalIndex, read_run_metadata, read_steps  # noqa: E402
+
+# Summary of a finished run as saved by eval.save_final_status: the agent's memory
+# written as chat messages, with images erased
+SUMMARY = [
+    {
+        "role": "system",
+        "content": [{"type": "text", "text": "You are a desktop agent."}],
+    },
+    {"role": "user", "content": [{"type": "text", "text": "New task:\nFind puppies"}]},
+    {
+        "role": "assistant",
+        "content": [{"type": "text", "text": "Thought: open the browser"}],
+    },
+    {
+        "role": "tool-call",
+        "content": [{"type": "text", "text": "Calling tools:\n[{'id': 'call_1'}]"}],
+    },
+    {
+        "role": "tool-response",
+        "content": [{"type": "text", "text": "Observation:\nOpened"}],
+    },
+    {"role": "assistant", "content": [{"type": "text", "text": "Thought: done"}]},
+    {
+        "role": "tool-call",
+        "content": [{"type": "text", "text": "Calling tools:\n[{'id': 'call_2'}]"}],
+    },
+    {
+        "role": "tool-response",
+        "content": [{"type": "text", "text": "Observation:\nDone"}],
+    },
+]
+
+# Step records as written by trace_writer.StepTraceWriter
+STEP_RECORDS = [
+    {"type": "PlanningStep", "step_number": None, "start_time": 90.0, "end_time": 95.0},
+    {"type": "ActionStep", "step_number": 1, "start_time": 100.0, "end_time": 104.0},
+    {"type": "ActionStep", "step_number": 2, "start_time": 104.0, "end_time": 112.5},
+]
+
+
+def write_run(run_dir, summary=SUMMARY, step_records=STEP_RECORDS, status="completed"):
+    os.makedirs(run_dir, exist_ok=True)
+    with open(os.path.join(run_dir, "task.txt"), "w") as f:
+        f.write("Find puppies")
+    if step_records is not None:
+        with open(os.path.join(run_dir, "steps.jsonl"), "w") as f:
+            for record in step_records:
+                f.write(json.dumps(record) + "\n")
+    if status is not None:
+        with open(os.path.join(run_dir, "metadata.json"), "w") as f:
+            f.write(
+                json.dumps(
+                    {"status": status, "summary": summary, "error_message": None}
+                )
+            )
+
+
+def test_read_run_metadata_counts_steps_from_trace(tmp_path):
+    write_run(str(tmp_path))
+    assert read_run_metadata(str(tmp_path)) == ("completed", 2, 12.5)
+
+
+def test_read_run_metadata_without_trace_counts_tool_calls(tmp_path):
+    write_run(str(tmp_path), step_records=None)
+    assert read_run_metadata(str(tmp_path)) == ("completed", 2, None)
+
+
+def test_read_run_metadata_of_running_run(tmp_path):
+    write_run(str(tmp_path), status=None)
+    with open(os.path.join(str(tmp_path), "steps.jsonl"), "a") as f:
+        f.write('{"type": "ActionStep", "start_ti')
+    assert read_run_metadata(str(tmp_path)) == ("running", 2, 12.5)
+
+
+def test_read_run_metadata_of_interrupted_run(tmp_path):
+    write_run(str(tmp_path), status=None)
+    for path in (str(tmp_path), os.path.join(str(tmp_path), "steps.jsonl")):
+        os.utime(path, (1, 1))
+    assert read_run_metadata(str(tmp_path)) == ("interrupted", 2, 12.5)
+
+
+def test_index_lists_step_counts_and_follows_trace(tmp_path):
+    base_dir = str(tmp_path)
+    run_dir = os.path.join(base_dir, "eval_1", "example_puppies", "run_0")
+    write_run(run_dir, status=None)
+    index = EvalIndex(base_dir, min_refresh_interval=0)
+    assert index.get_runs("eval_1", "puppies") == [
+        {"id": "run_0", "status": "running", "step_count": 2, "duration": 12.5}
+    ]
+
+    with open(os.path.join(run_dir, "steps.jsonl"), "a") as f:
+        f.write(
+            json.dumps({"type": "ActionStep", "start_time": 113.0, "end_time": 120.0})
+            + "\n"
+        )
+    os.utime(os.path.join(run_dir, "steps.jsonl"), (1, 1))
+    os.utime(run_dir, (1, 1))
+    assert index.get_runs("eval_1", "puppies")[0] == {
+        "id": "run_0",
+        "status": "interrupted",
+        "step_count": 3,
+        "duration": 20.0,
+    }
+
+
+def test_read_steps_keeps_its_index_out_of_the_run(tmp_path):
+    run_dir = os.path.join(str(tmp_path), "eval_1", "example_puppies", "run_0")
+    write_run(run_dir)
+    index_dir = os.path.join(str(tmp_path), ".steps_index")
+    run_mtime = os.stat(run_dir).st_mtime_ns
+
+    page = read_steps(run_dir, offset=1, limit=1, index_dir=index_dir)
+    assert page["status"] == "completed"
+    assert page["total"] == len(SUMMARY)
+    assert page["steps"] == SUMMARY[1:2]
+    assert os.stat(run_dir).st_mtime_ns == run_mtime
+    assert len(os.listdir(index_dir)) == 1
+
+
+def test_read_steps_of_run_saved_without_summary(tmp_path):
+    run_dir = str(tmp_path)
+    write_run(run_dir, summary=None)
+    with open(os.path.join(run_dir, "metadata.json"), "w") as f:
+        json.dump(
+            {"status": "failed", "error_message": "boom", "trace": "steps.jsonl"}, f
+        )
+
+    page = read_steps(run_dir, offset=1, limit=5)
+    assert page["status"] == "failed"
+    assert page["error_message"] == "boom"
+    assert page["total"] == len(STEP_RECORDS)
+    assert page["steps"] == STEP_RECORDS[1:]
+
+
+def test_read_run_metadata_of_saved_agent_run(tmp_path):
+    """Run recorded by trace_writer.StepTraceWriter and saved by eval.save_final_status"""
+    try:
+        from smolagents.memory import ActionStep, ToolCall
+
+        from eval import save_final_status
+        from trace_writer import StepTraceWriter
+    except Exception as e:
+        pytest.skip(f"eval.py dependencies unavailable: {e}")
+
+    trace_writer = StepTraceWriter(os.path.join(str(tmp_path), "steps.jsonl"))
+    for step_number in (1, 2):
+        trace_writer(
+            ActionStep(
+                step_number=step_number,
+                start_time=100.0 + step_number,
+                end_time=101.0 + step_number,
+                model_output="Thought: click",
+                tool_calls=[
+                    ToolCall(
+                        name="python_interpreter",
+                        arguments="click(1, 2)",
+                        id=f"call_{step_number}",
+                    )
+                ],
+                observations="Clicked",
+            )
+        )
+    trace_writer.close()
+    save_final_status(str(tmp_path), "completed")
+
+    assert read_run_metadata(str(tmp_path)) == ("completed", 2, 2.0)
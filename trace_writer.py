@@ -0,0 +1,91 @@
+import json
+import os
+import time
+from typing import Any, Dict
+
+from smolagents.memory import ActionStep, PlanningStep
+
+FSYNC_POLICIES = ("none", "flush", "fsync")
+
+
+class StepTraceWriter:
+    """Step callback appending one JSON record per agent step to a JSONL file, as steps happen.
+
+    Parameters:
+        path: The JSONL file to append to.
+        fsync: "none" leaves records in Python's buffer, "flush" hands each record to the OS
+            so that a crash of the process loses at most the step being written, and "fsync"
+            also forces it to disk.
+    """
+
+    def __init__(self, path: str, fsync: str = "flush"):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync should be one of {FSYNC_POLICIES}, got '{fsync}'")
+        self.path = path
+        self.fsync = fsync
+        self.file = open(path, "a")
+
+    def __call__(self, memory_step, agent=None) -> None:
+        if self.file.closed:
+            return
+        self.file.write(json.dumps(self.make_record(memory_step, agent), default=str))
+        self.file.write("\n")
+        if self.fsync != "none":
+            self.file.flush()
+        if self.fsync == "fsync":
+            os.fsync(self.file.fileno())
+
+    def make_record(self, memory_step, agent=None) -> Dict[str, Any]:
+        record = {
+            "type": type(memory_step).__name__,
+            "step_number": getattr(memory_step, "step_number", None),
+            "start_time": getattr(memory_step, "start_time", None),
+            "end_time": getattr(memory_step, "end_time", None),
+            "duration": getattr(memory_step, "duration", None),
+            "written_at": time.time(),
+        }
+        if isinstance(memory_step, ActionStep):
+            record.update(
+                {
+                    "model_output": memory_step.model_output,
+                    "tool_calls": [
+                        {"name": tool_call.name, "arguments": tool_call.arguments}
+                        for tool_call in memory_step.tool_calls or []
+                    ],
+                    "observations": memory_step.observations,
+                    "action_output": memory_step.action_output,
+                    "error": (
+                        {
+                            "type": type(memory_step.error).__name__,
+                            "message": str(memory_step.error),
+                        }
+                        if memory_step.error
+                        else None
+                    ),
+                }
+            )
+        elif isinstance(memory_step, PlanningStep):
+            record["plan"] = memory_step.plan
+
+        # Token counts are set on the step by stream_to_gradio, else read from the model
+        model = getattr(agent, "model", None)
+        record["input_token_count"] = getattr(
+            memory_step,
+            "input_token_count",
+            getattr(model, "last_input_token_count", None),
+        )
+        record["output_token_count"] = getattr(
+            memory_step,
+            "output_token_count",
+            getattr(model, "last_output_token_count", None),
+        )
+
+        step_metrics = getattr(agent, "step_metrics", {}).get(record["step_number"], {})
+        record["metrics"] = step_metrics
+        if step_metrics.get("screenshot_ref"):
+            record["screenshot"] = os.path.basename(step_metrics["screenshot_ref"])
+        return record
+
+    def close(self) -> None:
+        if not self.file.closed:
+            self.file.close()